@@ -1,24 +1,19 @@
 import json
 
 
-from PySide2.QtCore import QSize, Qt
+from PySide2.QtCore import QSize, Qt, Signal
 from PySide2.QtGui import QBrush, QPainter, QPen, QPixmap
 from PySide2.QtWidgets import (
     QComboBox,
-    QDialog,
     QLabel,
-    QLineEdit,
     QMenu,
-    QPushButton,
     QTextEdit,
-    QVBoxLayout,
 )
 
 
-from collections import OrderedDict
-
 from util import get_config, save_config
-from meta_schema import PEOPLE_METADATA
+from metadata import person_key, person_label
+from PersonDialog import PersonDialog
 from PersonSearchDialog import PersonSearchDialog
 
 
@@ -31,10 +26,37 @@ def get_text_content(component):
         return component.text()
 
 
+def remember_recent_person(metadata):
+    """Put a person last in recent_people, replacing earlier entries of the same person"""
+    config = get_config()
+    recent_people = json.loads(config.get("General", "recent_people", fallback="[]"))
+    key = person_key(metadata)
+    recent_people = [person for person in recent_people if person_key(person) != key]
+    recent_people.append(metadata)
+    save_config({"recent_people": json.dumps(recent_people)})
+
+
 class ImageLabel(QLabel):
-    def __init__(self, parent=None, people: list[dict] | None = None):
+    # coordinates and metadata of a person that was added or edited
+    person_changed = Signal(object, object)
+    # coordinates of a person that was removed
+    person_removed = Signal(object)
+
+    def __init__(
+        self,
+        parent=None,
+        people: list[dict] | None = None,
+        cooccurrence=None,
+        get_metadata=None,
+        family_tree=None,
+    ):
         super().__init__(parent)
         self.people = people
+        # CooccurrenceIndex and a function returning the current image fields, for suggestions
+        self.cooccurrence = cooccurrence
+        self.get_metadata = get_metadata
+        # FamilyTree imported from GEDCOM, searched in the person dialogs
+        self.family_tree = family_tree
         self.setAlignment(Qt.AlignCenter)
         self.setScaledContents(True)
         self.setFixedSize(512, 512)
@@ -46,6 +68,8 @@ class ImageLabel(QLabel):
         self.people_dots_pen = Qt.black
         self.people_dots_pen_width = 2
 
+        self.person_dialog = PersonDialog(self, family_tree)
+
     def setPixmap(self, arg__1: QPixmap) -> None:
         if arg__1.height() != 0:
             aspect_ratio = arg__1.width() / arg__1.height()
@@ -73,62 +97,30 @@ class ImageLabel(QLabel):
                 self.people_dots_size,
             )
 
+    def add_person(self, x, y, metadata):
+        metadata = list(dict(metadata or []).items())
+        self.people.append(
+            {
+                "coordinates": (x, y),
+                "metadata": metadata,
+            }
+        )
+        self.person_changed.emit((x, y), metadata)
+        self.update()
+
     def remove_person(self, x, y):
         self.people.remove(
             next(person for person in self.people if person["coordinates"] == (x, y))
         )
+        self.person_removed.emit((x, y))
 
     def edit_person(self, x, y, values: dict | None = None):
-        dialog = QDialog(self)
-        dialog.setWindowTitle("Tagga person")
-        dialog.setModal(True)
-        # dialog.resize(400, 300)
-        dialog.setLayout(QVBoxLayout())
-
-        fields = OrderedDict()
-        for key, value in PEOPLE_METADATA.items():
-            label = QLabel(value["label"])
-            dialog.layout().addWidget(label)
-            if value.get("values"):
-                field_input = QComboBox()
-                field_input.addItem("")
-                field_input.addItems(value["values"])
-            elif value.get("multiline"):
-                field_input = QTextEdit()
-                field_input.setPlaceholderText("  |  ".join(value["examples"]))
-            else:
-                field_input = QLineEdit()
-                field_input.setPlaceholderText("  |  ".join(value["examples"]))
-            fields[key] = field_input
-            dialog.layout().addWidget(field_input)
-            if value.get("multiline"):
-                dialog.layout().addStretch(1)
-
-        if values is not None:
-            for key, value in values.items():
-                field = fields.get(key)
-                if field and isinstance(field, QComboBox):
-                    field.setCurrentText(value)
-                elif field:
-                    field.setText(value)
-
-            delete_button = QPushButton("Ta bort")
-            delete_button.clicked.connect(
-                lambda: self.remove_person(x, y) or dialog.reject()
-            )
-            dialog.layout().addWidget(delete_button)
-
-        submit_button = QPushButton("Submit")
-        submit_button.setDefault(True)
-        dialog.setFocusProxy(submit_button)
-        submit_button.clicked.connect(dialog.accept)
-        dialog.closeEvent = lambda event: dialog.reject()
-
-        dialog.layout().addWidget(submit_button)
-        dialog.exec_()
-
-        if dialog.result():
-            self.save_person(fields, x, y)
+        result = self.person_dialog.ask(values)
+        if result == PersonDialog.Deleted:
+            self.remove_person(x, y)
+            self.update()
+        elif result:
+            self.save_person(self.person_dialog.fields, x, y)
 
     def save_person(self, fields, x, y):
         metadata = []
@@ -137,42 +129,15 @@ class ImageLabel(QLabel):
             if text_content:
                 metadata.append((key, text_content))
         if metadata:
-            config = get_config()
-            recent_people = config.get("General", "recent_people", fallback=None)
-            if recent_people:
-                recent_people = json.loads(recent_people)
-            else:
-                recent_people = []
             for person in self.people:
                 px, py = person["coordinates"]
                 if px == x and py == y:
                     person["metadata"] = metadata
-                    metadata_dict = dict(metadata)
-                    for recent_person in recent_people:
-                        recent_person_dict = dict(recent_person)
-                        if (
-                            recent_person_dict.get("förnamn", "").lower()
-                            == metadata_dict.get("förnamn", "").lower()
-                            and recent_person_dict.get("efternamn", "").lower()
-                            == metadata_dict.get("efternamn", "").lower()
-                            and recent_person_dict.get("födelsedatum", "").lower()
-                            == metadata_dict.get("födelsedatum", "").lower()
-                        ):
-                            recent_people.remove(recent_person)
-                            recent_people.append(metadata)
-                            break
-                    else:
-                        recent_people.append(metadata)
-                    save_config({"recent_people": json.dumps(recent_people)})
-                    return
-            self.people.append(
-                {
-                    "coordinates": (x, y),
-                    "metadata": metadata,
-                }
-            )
-            recent_people.append(metadata)
-            save_config({"recent_people": json.dumps(recent_people)})
+                    self.person_changed.emit((x, y), metadata)
+                    break
+            else:
+                self.add_person(x, y, metadata)
+            remember_recent_person(metadata)
 
     def mousePressEvent(self, event):
         if event.button() == Qt.LeftButton:
@@ -194,49 +159,40 @@ class ImageLabel(QLabel):
             menu.addAction("Tidigare ifylld person")
             config = get_config()
             recent_people_str = config.get("General", "recent_people", fallback="[]")
+            suggested = {}
+            if self.cooccurrence is not None:
+                metadata = self.get_metadata() if self.get_metadata else []
+                suggestions = self.cooccurrence.suggest(self.people, metadata)
+                if suggestions:
+                    menu.addSection("Förslag")
+                    for person in suggestions:
+                        suggested[menu.addAction(person_label(person))] = person
             menu.addSeparator()
             recent_people = json.loads(recent_people_str)
             for person in reversed(recent_people[-5:]):
-                person_metadata = dict(person)
-                menu.addAction(
-                    f"{person_metadata.pop('förnamn', '')} {person_metadata.pop('efternamn', '')} ({person_metadata.pop('födelsedatum', '')})"
-                )
+                menu.addAction(person_label(person))
 
             action = menu.exec_(self.mapToGlobal(event.pos()))
             if action:
-                if action.text() == "Tagga person":
+                if action in suggested:
+                    self.add_person(x, y, suggested[action])
+                elif action.text() == "Tagga person":
                     self.edit_person(x, y)
                 elif action.text() == "Okänd person":
-                    self.people.append(
-                        {
-                            "coordinates": (x, y),
-                            "metadata": [],
-                        }
-                    )
-                    self.update()
+                    self.add_person(x, y, [])
                 elif action.text() == "Tidigare ifylld person":
-                    # display dialog to search for person in recent_people
-                    dialog = PersonSearchDialog(self, recent_people=recent_people)
+                    # display dialog to search for person in recent_people and the family tree
+                    dialog = PersonSearchDialog(
+                        self, recent_people=recent_people, family_tree=self.family_tree
+                    )
                     if dialog.exec_():
-                        self.people.append(
-                            {
-                                "coordinates": (x, y),
-                                "metadata": dialog.person,
-                            }
-                        )
-                        self.update()
+                        self.add_person(x, y, dialog.person)
+                        if dialog.person in dialog.tree_matches.values():
+                            remember_recent_person(list(dialog.person.items()))
+                    dialog.deleteLater()
                 else:
                     for person in recent_people:
-                        person_metadata = dict(person)
-                        if (
-                            action.text()
-                            == f"{person_metadata.pop('förnamn', '')} {person_metadata.pop('efternamn', '')} ({person_metadata.pop('födelsedatum', '')})"
-                        ):
-                            self.people.append(
-                                {
-                                    "coordinates": (x, y),
-                                    "metadata": person,
-                                }
-                            )
-                            self.update()
+                        if action.text() == person_label(person):
+                            self.add_person(x, y, person)
                             break
+            menu.deleteLater()
@@ -0,0 +1,136 @@
+from collections import deque, OrderedDict
+import time
+
+from PySide2.QtCore import QStringListModel, Qt
+from PySide2.QtWidgets import (
+    QComboBox,
+    QCompleter,
+    QDialog,
+    QLabel,
+    QLineEdit,
+    QPushButton,
+    QTextEdit,
+    QVBoxLayout,
+)
+
+from gedcom import TREE_FIELDS, tree_label
+from meta_schema import PEOPLE_METADATA
+
+
+class PersonDialog(QDialog):
+    """Dialog to tag a person. Built once from PEOPLE_METADATA and reset every time it is opened, so opening it is instant."""
+
+    # exec_ result when "Ta bort" was pressed
+    Deleted = 2
+
+    def __init__(self, parent=None, family_tree=None):
+        super().__init__(parent)
+        self.setWindowTitle("Tagga person")
+        self.setModal(True)
+        self.setLayout(QVBoxLayout())
+
+        # search in an imported family tree that fills in name, PersonID, dates and places
+        self.family_tree = family_tree
+        self.tree_matches = {}
+        self.tree_label = QLabel("Sök i släktträdet:")
+        self.layout().addWidget(self.tree_label)
+        self.tree_search = QLineEdit()
+        self.tree_search.setPlaceholderText("Namn, födelseår, ort eller PersonID")
+        self.tree_model = QStringListModel(self.tree_search)
+        completer = QCompleter(self.tree_model, self.tree_search)
+        completer.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
+        completer.setCaseSensitivity(Qt.CaseInsensitive)
+        completer.setMaxVisibleItems(15)
+        completer.activated[str].connect(self.pick_from_tree)
+        self.tree_search.setCompleter(completer)
+        self.tree_search.textEdited.connect(self.search_tree)
+        self.layout().addWidget(self.tree_search)
+
+        self.fields = OrderedDict()
+        for key, value in PEOPLE_METADATA.items():
+            label = QLabel(value["label"])
+            self.layout().addWidget(label)
+            if value.get("values"):
+                field_input = QComboBox()
+                field_input.addItem("")
+                field_input.addItems(value["values"])
+            elif value.get("multiline"):
+                field_input = QTextEdit()
+                field_input.setPlaceholderText("  |  ".join(value["examples"]))
+            else:
+                field_input = QLineEdit()
+                field_input.setPlaceholderText("  |  ".join(value["examples"]))
+            self.fields[key] = field_input
+            self.layout().addWidget(field_input)
+            if value.get("multiline"):
+                self.layout().addStretch(1)
+
+        self.delete_button = QPushButton("Ta bort")
+        self.delete_button.setAutoDefault(False)
+        self.delete_button.clicked.connect(lambda: self.done(self.Deleted))
+        self.layout().addWidget(self.delete_button)
+
+        # Enter in any line edit submits, Escape cancels
+        self.submit_button = QPushButton("Submit")
+        self.submit_button.setDefault(True)
+        self.submit_button.clicked.connect(self.accept)
+        self.layout().addWidget(self.submit_button)
+
+        # seconds from ask until the dialog was shown, for the last openings
+        self.open_latencies = deque(maxlen=100)
+        self.ask_started = None
+
+    def reset(self, values: dict | None = None):
+        """Clear all fields and fill in values, if editing an already tagged person"""
+        for key, field in self.fields.items():
+            value = (values or {}).get(key, "")
+            if isinstance(field, QComboBox):
+                field.setCurrentText(value)
+            elif isinstance(field, QTextEdit):
+                field.setPlainText(value)
+            else:
+                field.setText(value)
+        self.delete_button.setVisible(values is not None)
+
+        has_tree = self.family_tree is not None and len(self.family_tree) > 0
+        self.tree_label.setVisible(has_tree)
+        self.tree_search.setVisible(has_tree)
+        self.tree_search.clear()
+
+        # type the name of a new person right away, or press Enter to keep an edited one
+        if values is None:
+            first_field = next(iter(self.fields.values()))
+            (self.tree_search if has_tree else first_field).setFocus()
+        else:
+            self.submit_button.setFocus()
+
+    def ask(self, values: dict | None = None) -> int:
+        """Show the dialog for a new person or, with values, an existing one.
+
+        Returns QDialog.Accepted, QDialog.Rejected or PersonDialog.Deleted.
+        """
+        self.ask_started = time.perf_counter()
+        self.reset(values)
+        return self.exec_()
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        if self.ask_started is not None:
+            self.open_latencies.append(time.perf_counter() - self.ask_started)
+            self.ask_started = None
+
+    def search_tree(self, text: str):
+        people = self.family_tree.search(text)
+        self.tree_matches = {tree_label(person): person for person in people}
+        self.tree_model.setStringList(list(self.tree_matches))
+        self.tree_search.completer().complete()
+
+    def pick_from_tree(self, label: str):
+        """Fill in the fields known from the family tree, the others are kept"""
+        person = self.tree_matches.get(label)
+        if person is None:
+            return
+        for key in TREE_FIELDS:
+            if key in self.fields:
+                self.fields[key].setText(person.get(key, ""))
+        self.submit_button.setFocus()
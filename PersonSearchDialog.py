@@ -1,10 +1,15 @@
 from PySide2.QtWidgets import QComboBox, QDialog, QLineEdit, QVBoxLayout
 
+from gedcom import tree_label
+from metadata import person_label
+
 
 class PersonSearchDialog(QDialog):
-    """Dialog to search for person in recent_people. Contains a search box and buttons to select any of the top search results."""
+    """Dialog to search for person in recent_people and the imported family tree. Contains a search box and buttons to select any of the top search results."""
 
-    def __init__(self, parent=None, recent_people: list[dict] | None = None):
+    def __init__(
+        self, parent=None, recent_people: list[dict] | None = None, family_tree=None
+    ):
         super().__init__(parent)
         self.setWindowTitle("Sök person")
         self.setModal(True)
@@ -24,9 +29,13 @@ class PersonSearchDialog(QDialog):
         self.person = None
 
         self.recent_people = recent_people
+        self.family_tree = family_tree
+        # label -> metadata of the people from the family tree in the results
+        self.tree_matches = {}
 
     def search(self, text):
         self.results.clear()
+        self.tree_matches = {}
         if self.recent_people:
             matches = []
             for person in self.recent_people:
@@ -36,19 +45,19 @@ class PersonSearchDialog(QDialog):
                     or text.lower() in person_metadata.get("efternamn", "").lower()
                     or text.lower() in person_metadata.get("födelsedatum", "").lower()
                 ):
-                    matches.append(
-                        f"{person_metadata.get('förnamn', '')} {person_metadata.get('efternamn', '')} ({person_metadata.get('födelsedatum', '')})"
-                    )
+                    matches.append(person_label(person))
             self.results.addItems(matches[:10])
+        if self.family_tree is not None and text.strip():
+            for person in self.family_tree.search(text, limit=10):
+                self.tree_matches[tree_label(person)] = person
+            self.results.addItems(list(self.tree_matches))
 
     def accept(self):
-        if self.recent_people:
+        if self.results.currentText() in self.tree_matches:
+            self.person = self.tree_matches[self.results.currentText()]
+        elif self.recent_people:
             for person in self.recent_people:
-                person_metadata = dict(person)
-                if (
-                    f"{person_metadata.get('förnamn', '')} {person_metadata.get('efternamn', '')} ({person_metadata.get('födelsedatum', '')})"
-                    == self.results.currentText()
-                ):
-                    self.person = person_metadata
+                if person_label(person) == self.results.currentText():
+                    self.person = dict(person)
                     break
         super().accept()
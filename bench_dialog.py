@@ -0,0 +1,64 @@
+"""Time opening the person dialog, built for every click as before or built once and reset.
+
+python bench_dialog.py --runs 200
+"""
+
+import argparse
+import os
+import statistics
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PySide2.QtCore import QEvent
+from PySide2.QtWidgets import QApplication
+
+from PersonDialog import PersonDialog
+
+VALUES = {"förnamn": "Nina", "efternamn": "Eriksson", "födelsedatum": "1920"}
+
+
+def show(app, dialog):
+    dialog.show()
+    app.processEvents()
+    dialog.hide()
+
+
+def median_ms(timings: list[float]) -> str:
+    return f"{statistics.median(timings) * 1000:.3f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=200)
+    args = parser.parse_args()
+
+    app = QApplication([])
+    build, build_and_show, reset, reset_and_show = [], [], [], []
+    for _ in range(args.runs):
+        started = time.perf_counter()
+        dialog = PersonDialog()
+        build.append(time.perf_counter() - started)
+        show(app, dialog)
+        build_and_show.append(time.perf_counter() - started)
+        dialog.deleteLater()
+        app.sendPostedEvents(None, QEvent.DeferredDelete)
+
+    dialog = PersonDialog()
+    show(app, dialog)
+    for run in range(args.runs):
+        started = time.perf_counter()
+        dialog.reset(VALUES if run % 2 else None)
+        reset.append(time.perf_counter() - started)
+        show(app, dialog)
+        reset_and_show.append(time.perf_counter() - started)
+
+    print(f"Medians over {args.runs} openings")
+    print(f"  build PersonDialog():  {median_ms(build)}")
+    print(f"  build and show:        {median_ms(build_and_show)}")
+    print(f"  reset():               {median_ms(reset)}")
+    print(f"  reset and show:        {median_ms(reset_and_show)}")
+
+
+if __name__ == "__main__":
+    main()
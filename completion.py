@@ -0,0 +1,165 @@
+from bisect import bisect_left, insort
+import heapq
+from pathlib import Path
+import threading
+
+from metadata import iter_sidecars, load_info
+
+# Image fields that get autocompletion, with the separator for fields holding several values
+COMPLETION_FIELDS = {
+    "plats": None,
+    "fotograf": None,
+    "källa": None,
+    "nyckelord": ",",
+}
+
+
+class PrefixIndex:
+    """Previously used values of one field, sorted for prefix lookups and weighted by how often they were used.
+
+    Prefixes matching more values than scan_limit keep a cached top list that is updated
+    when values are added, so short prefixes never scan the whole range.
+    """
+
+    scan_limit = 256
+    cache_size = 20
+
+    def __init__(self):
+        # lowercase value -> [value as last written, number of uses]
+        self.values: dict[str, list] = {}
+        self.keys: list[str] = []
+        self.cache: dict[str, list[str]] = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _rank(self, key: str):
+        return (-self.values[key][1], key)
+
+    def add(self, value: str, count: int = 1):
+        value = value.strip()
+        key = value.lower()
+        if not key:
+            return
+        if key in self.values:
+            entry = self.values[key]
+            entry[0] = value
+            entry[1] += count
+        else:
+            self.values[key] = [value, count]
+            insort(self.keys, key)
+
+        for i in range(len(key) + 1):
+            cached = self.cache.get(key[:i])
+            if cached is None:
+                continue
+            if key not in cached:
+                cached.append(key)
+            cached.sort(key=self._rank)
+            del cached[self.cache_size :]
+
+    def warm(self):
+        """Fill the cached top lists of every prefix matching more than scan_limit values, so no lookup scans"""
+        length = 0
+        large = True
+        while large:
+            large = False
+            start = 0
+            while start < len(self.keys):
+                if len(self.keys[start]) < length:
+                    start += 1
+                    continue
+                prefix = self.keys[start][:length]
+                end = bisect_left(self.keys, prefix + "\U0010ffff", start)
+                if end - start > self.scan_limit:
+                    large = True
+                    self.cache[prefix] = heapq.nsmallest(
+                        self.cache_size, self.keys[start:end], key=self._rank
+                    )
+                start = end
+            length += 1
+
+    def complete(self, prefix: str, limit: int = 10) -> list[str]:
+        prefix = prefix.strip().lower()
+        start = bisect_left(self.keys, prefix)
+        end = bisect_left(self.keys, prefix + "\U0010ffff", start)
+        if end - start <= self.scan_limit:
+            ranked = heapq.nsmallest(limit, self.keys[start:end], key=self._rank)
+        else:
+            ranked = self.cache.get(prefix)
+            if ranked is None or len(ranked) < min(limit, self.cache_size):
+                ranked = heapq.nsmallest(
+                    max(limit, self.cache_size),
+                    self.keys[start:end],
+                    key=self._rank,
+                )
+                self.cache[prefix] = ranked[: self.cache_size]
+            ranked = ranked[:limit]
+        return [self.values[key][0] for key in ranked]
+
+
+class CompletionEngine:
+    """Autocompletion of the image fields from values used in earlier metadata files"""
+
+    def __init__(self, fields: dict[str, str | None] = COMPLETION_FIELDS):
+        self.separators = dict(fields)
+        self.indexes = {field: PrefixIndex() for field in fields}
+        self.lock = threading.Lock()
+        self.loaded = threading.Event()
+        # resolved folders that were read, so a folder added later is read once
+        self.directories: set[Path] = set()
+
+    def record(self, metadata):
+        """Add the values of a submitted image"""
+        metadata = dict(metadata)
+        with self.lock:
+            for field, index in self.indexes.items():
+                text = metadata.get(field, "")
+                separator = self.separators[field]
+                for value in text.split(separator) if separator else [text]:
+                    index.add(value)
+
+    def load(self, directories, recursive: bool = True):
+        """Read the history of the metadata files in directories not read before, meant to run in a background thread"""
+        with self.lock:
+            directories = [
+                directory
+                for directory in dict.fromkeys(
+                    Path(directory).resolve() for directory in directories
+                )
+                if directory not in self.directories
+            ]
+            self.directories.update(directories)
+        for directory in directories:
+            for meta_file in iter_sidecars(directory, recursive):
+                try:
+                    info = load_info(meta_file)
+                except (OSError, ValueError):
+                    continue
+                self.record(info)
+        for index in self.indexes.values():
+            with self.lock:
+                index.warm()
+        self.loaded.set()
+
+    def load_in_background(self, directories, recursive: bool = True):
+        thread = threading.Thread(
+            target=self.load, args=(list(directories), recursive), daemon=True
+        )
+        thread.start()
+        return thread
+
+    def complete(self, field: str, text: str, limit: int = 10) -> list[str]:
+        """Completions for the whole text of a field, only the last value is completed in separated fields"""
+        index = self.indexes.get(field)
+        if index is None:
+            return []
+        separator = self.separators[field]
+        head, token = "", text
+        if separator and separator in text:
+            head, _, token = text.rpartition(separator)
+            head += separator + " "
+        if not token.strip() and not head:
+            return []
+        with self.lock:
+            return [head + value for value in index.complete(token, limit)]
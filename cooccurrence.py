@@ -0,0 +1,264 @@
+import json
+from pathlib import Path
+import threading
+
+from metadata import iter_sidecars, load_info, person_key
+from util import app_data_path
+
+INDEX_PATH = app_data_path("slaktskanning_personer.json")
+
+SOURCE_FIELDS = ("källa", "sammanhang")
+
+
+def source_anchors(metadata) -> list[str]:
+    """Keys for the källa and sammanhang of an image, so they can be counted like people"""
+    metadata = dict(metadata)
+    anchors = []
+    for field in SOURCE_FIELDS:
+        text = metadata.get(field, "").strip().lower()
+        if text:
+            anchors.append(f"{field}:{text}")
+    return anchors
+
+
+class CooccurrenceIndex:
+    """Counts how often people appear together, and with the same källa or sammanhang, in saved metadata files.
+
+    Ranked suggestions for every person and source are kept up to date when a file is added,
+    so looking them up when clicking on the image does not scan any history.
+
+    Changes are appended to a log next to the index file, and the whole index is only
+    written after a rebuild or when the log has grown to compact_after records.
+    """
+
+    top_size = 20
+    compact_after = 500
+
+    def __init__(self, path: Path = INDEX_PATH):
+        self.path = Path(path)
+        self.log_path = self.path.with_suffix(".log")
+        self.log_records = 0
+        # set once the index was built from the metadata files, even if there were none
+        self.built = False
+        # resolved folders whose metadata files were read into the index
+        self.roots: list[str] = []
+        # the index is rebuilt in a background thread while it is used
+        self.lock = threading.RLock()
+        # one rebuild or update of the folders at a time
+        self.update_lock = threading.Lock()
+        # person key -> latest metadata for that person
+        self.people: dict[str, list] = {}
+        # anchor (person key or source) -> {person key: number of images together}
+        self.counts: dict[str, dict[str, int]] = {}
+        # metadata file -> what it contributed, so a rewrite can be subtracted first
+        self.files: dict[str, dict[str, list[str]]] = {}
+        # anchor -> [(count, person key), ...] sorted with the highest count first
+        self.top: dict[str, list[tuple[int, str]]] = {}
+
+    @classmethod
+    def load(cls, path: Path = INDEX_PATH):
+        index = cls(path)
+        try:
+            data = json.loads(index.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            data = {}
+        index.people = data.get("people", {})
+        index.counts = data.get("counts", {})
+        index.files = data.get("files", {})
+        index.built = data.get("built", bool(index.files))
+        index.roots = data.get("roots", [])
+        index.replay_log()
+        index.refresh(index.counts.keys())
+        return index
+
+    def replay_log(self):
+        try:
+            lines = self.log_path.read_text(encoding="utf-8").splitlines()
+        except OSError:
+            return
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line may be cut off
+                break
+            if record["op"] == "add":
+                self._add(record["file"], record["people"], record["anchors"])
+            elif record["op"] == "remove":
+                self._remove(record["file"])
+            elif record["op"] == "move":
+                self._move(record["file"], record["new_file"])
+            self.log_records += 1
+
+    def save(self):
+        """Write the whole index and empty the log"""
+        with self.lock:
+            data = {
+                "people": self.people,
+                "counts": self.counts,
+                "files": self.files,
+                "built": self.built,
+                "roots": self.roots,
+            }
+            tmp_path = self.path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+            tmp_path.replace(self.path)
+            self.log_path.write_text("", encoding="utf-8")
+            self.log_records = 0
+
+    def _log(self, record: dict):
+        with open(self.log_path, "a", encoding="utf-8") as log:
+            log.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.log_records += 1
+        if self.log_records >= self.compact_after:
+            self.save()
+
+    def __len__(self):
+        return len(self.files)
+
+    def rebuild(self, directories, recursive: bool = True):
+        """Build the index from scratch from all metadata files in the directories"""
+        with self.lock:
+            self.people.clear()
+            self.counts.clear()
+            self.files.clear()
+            self.top.clear()
+            self.roots = []
+            self.built = False
+        self.add_directories(directories, recursive)
+
+    def add_directories(self, directories, recursive: bool = True):
+        """Count the metadata files in the directories that were not read into the index before"""
+        with self.lock:
+            new = [
+                directory
+                for directory in dict.fromkeys(
+                    str(Path(directory).resolve()) for directory in directories
+                )
+                if directory not in self.roots
+            ]
+            if self.built and not new:
+                return
+        for directory in new:
+            for meta_file in iter_sidecars(directory, recursive):
+                try:
+                    info = load_info(meta_file)
+                except (OSError, ValueError):
+                    print(f"Could not read {meta_file}, skipping")
+                    continue
+                self.add_file(meta_file, info, info["personer"], save=False)
+        with self.lock:
+            self.roots += new
+            self.built = True
+            self.save()
+
+    def update(self, directories, recursive: bool = True):
+        """Build the index if it never was, otherwise add the directories not read before"""
+        with self.update_lock:
+            if self.built:
+                self.add_directories(directories, recursive)
+            else:
+                self.rebuild(directories, recursive)
+
+    def update_in_background(self, directories, recursive: bool = True):
+        thread = threading.Thread(
+            target=self.update, args=(list(directories), recursive), daemon=True
+        )
+        thread.start()
+        return thread
+
+    def add_file(self, meta_file, metadata, people: list[dict], save: bool = True):
+        """Count the people and sources in a saved metadata file, replacing its earlier version"""
+        file_key = str(Path(meta_file).absolute())
+        persons = {}
+        for person in people:
+            key = person_key(person.get("metadata", []))
+            if key.strip("|") and key not in persons:
+                persons[key] = [list(field) for field in person["metadata"]]
+        anchors = list(persons) + source_anchors(metadata)
+
+        with self.lock:
+            self._add(file_key, persons, anchors)
+            if save:
+                self._log(
+                    {
+                        "op": "add",
+                        "file": file_key,
+                        "people": persons,
+                        "anchors": anchors,
+                    }
+                )
+
+    def _add(self, file_key: str, persons: dict[str, list], anchors: list[str]):
+        self._remove(file_key)
+        self.people.update(persons)
+        self._count(anchors, list(persons), 1)
+        self.files[file_key] = {"people": list(persons), "anchors": anchors}
+
+    def remove_file(self, meta_file, save: bool = True):
+        file_key = str(Path(meta_file).absolute())
+        with self.lock:
+            if self._remove(file_key) and save:
+                self._log({"op": "remove", "file": file_key})
+
+    def _remove(self, file_key: str) -> bool:
+        contribution = self.files.pop(file_key, None)
+        if contribution:
+            self._count(contribution["anchors"], contribution["people"], -1)
+        return bool(contribution)
+
+    def move_file(self, meta_file, new_meta_file):
+        """Keep counting a metadata file that was moved together with its image"""
+        file_key = str(Path(meta_file).absolute())
+        new_file_key = str(Path(new_meta_file).absolute())
+        with self.lock:
+            if self._move(file_key, new_file_key):
+                self._log({"op": "move", "file": file_key, "new_file": new_file_key})
+
+    def _move(self, file_key: str, new_file_key: str) -> bool:
+        contribution = self.files.pop(file_key, None)
+        if contribution:
+            self.files[new_file_key] = contribution
+        return bool(contribution)
+
+    def _count(self, anchors: list[str], persons: list[str], change: int):
+        for anchor in anchors:
+            counts = self.counts.setdefault(anchor, {})
+            for person in persons:
+                if person == anchor:
+                    continue
+                counts[person] = counts.get(person, 0) + change
+                if counts[person] <= 0:
+                    del counts[person]
+            if not counts:
+                del self.counts[anchor]
+        self.refresh(anchors)
+
+    def refresh(self, anchors):
+        for anchor in anchors:
+            counts = self.counts.get(anchor)
+            if counts:
+                self.top[anchor] = sorted(
+                    ((count, person) for person, count in counts.items()),
+                    reverse=True,
+                )[: self.top_size]
+            else:
+                self.top.pop(anchor, None)
+
+    def suggest(self, tagged: list[dict], metadata, limit: int = 5) -> list[list]:
+        """Metadata of the people most likely to also be in an image, best first.
+
+        tagged is the people already marked in the image and metadata the image fields.
+        """
+        tagged_keys = {person_key(person.get("metadata", [])) for person in tagged}
+        anchors = [key for key in tagged_keys if key.strip("|")]
+        anchors += source_anchors(metadata)
+
+        scores = {}
+        with self.lock:
+            for anchor in anchors:
+                for count, person in self.top.get(anchor, []):
+                    if person not in tagged_keys:
+                        scores[person] = scores.get(person, 0) + count
+            ranked = sorted(scores, key=lambda person: (-scores[person], person))
+            return [self.people[person] for person in ranked[:limit]]
@@ -0,0 +1,364 @@
+"""Headless annotation server.
+
+Owns the folder watching, the queue of new scans and the writing of metadata files,
+so that several annotators (PhotoMetaApp with daemon_url in the config) can work on
+the same archive at once. Every client leases one image at a time, and a lease that is
+not renewed before it times out puts the image back in the queue.
+
+Run with `python daemon.py`, it watches the folders from the config file.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+from urllib.request import Request, urlopen
+import uuid
+
+from metadata import file_digest, save_info
+from postprocess import PostProcessor
+from scanning import ScanWatcher, WatchRoot, load_watch_roots
+
+DEFAULT_PORT = 8765
+LEASE_TIMEOUT = 10 * 60
+# seconds an image released by a client is not handed to that client again
+RELEASE_COOLDOWN = 10 * 60
+
+
+class LeaseError(Exception):
+    """The lease does not exist or has expired"""
+
+
+def fields_from_json(fields) -> list[tuple[str, str]]:
+    """[[key, value], ...] from a request as the pairs save_info takes, ValueError if malformed"""
+    if not isinstance(fields, list):
+        raise ValueError("Expected a list of [key, value] pairs")
+    if not all(
+        isinstance(field, list)
+        and len(field) == 2
+        and all(isinstance(part, str) for part in field)
+        for field in fields
+    ):
+        raise ValueError("Expected a list of [key, value] pairs")
+    return [tuple(field) for field in fields]
+
+
+def person_from_json(person) -> dict:
+    """A tagged person from a request, ValueError if malformed"""
+    if not isinstance(person, dict):
+        raise ValueError("Expected a person object")
+    coordinates = tuple(person.get("coordinates", (None, None)))
+    if len(coordinates) != 2 or not all(
+        value is None or isinstance(value, (int, float)) for value in coordinates
+    ):
+        raise ValueError("Expected coordinates as [x, y]")
+    return dict(
+        person,
+        coordinates=coordinates,
+        metadata=fields_from_json(person.get("metadata", [])),
+    )
+
+
+class AnnotationDaemon:
+    def __init__(self, roots: list[WatchRoot], lease_timeout: float = LEASE_TIMEOUT):
+        self.lease_timeout = lease_timeout
+        self.lock = threading.Lock()
+        # lease id -> {"image": Path, "client": str, "expires": float, "digest": Future}
+        self.leases: dict[str, dict] = {}
+        self.submitted = 0
+        # (client, image) -> time it was released, so a closed image is not reopened at once
+        self.released: dict[tuple, float] = {}
+        # images are hashed as soon as they are leased, while they are being annotated
+        self.hash_executor = ThreadPoolExecutor(max_workers=2)
+        self.watcher = ScanWatcher(
+            postprocessor=PostProcessor.from_config(),
+            on_image_moved=self.image_moved,
+        )
+        self.roots = roots
+
+    def start(self):
+        self.watcher.set_roots(self.roots)
+
+    def stop(self):
+        self.watcher.shutdown()
+        self.hash_executor.shutdown(cancel_futures=True)
+
+    def expire_leases(self):
+        now = time.monotonic()
+        with self.lock:
+            expired = [
+                lease_id
+                for lease_id, lease in self.leases.items()
+                if lease["expires"] < now
+            ]
+            for lease_id in expired:
+                self.watcher.queue.requeue(self.leases.pop(lease_id)["image"])
+
+    def image_moved(self, image, new_image):
+        """Follow a leased image that was renamed or moved, called from the watcher"""
+        with self.lock:
+            for lease in self.leases.values():
+                if lease["image"] == image.resolve():
+                    lease["image"] = new_image.resolve()
+
+    def _get_lease(self, lease_id: str) -> dict:
+        lease = self.leases.get(lease_id)
+        if lease is None or lease["expires"] < time.monotonic():
+            raise LeaseError(f"Unknown or expired lease {lease_id}")
+        return lease
+
+    def lease(self, client: str = "") -> dict | None:
+        """Hand out the next image in the queue, or None if there is nothing to do"""
+        self.expire_leases()
+        now = time.monotonic()
+        skipped = []
+        with self.lock:
+            self.released = {
+                key: released
+                for key, released in self.released.items()
+                if now - released < RELEASE_COOLDOWN
+            }
+            while True:
+                image = self.watcher.queue.get()
+                if image is None or (client, image) not in self.released:
+                    break
+                skipped.append(image)
+        # images put aside by this client stay first in the queue for the others
+        for skipped_image in reversed(skipped):
+            self.watcher.queue.requeue(skipped_image)
+        if image is None:
+            return None
+        lease_id = uuid.uuid4().hex
+        digest = self.hash_executor.submit(file_digest, image)
+        self.watcher.queue.set_fingerprint(image, digest)
+        with self.lock:
+            self.leases[lease_id] = {
+                "image": image,
+                "client": client,
+                "expires": time.monotonic() + self.lease_timeout,
+                "digest": digest,
+            }
+        return {"lease": lease_id, "image": str(image), "timeout": self.lease_timeout}
+
+    def renew(self, lease_id: str):
+        with self.lock:
+            lease = self._get_lease(lease_id)
+            lease["expires"] = time.monotonic() + self.lease_timeout
+
+    def release(self, lease_id: str):
+        """Give the image back without metadata, so another annotator can take it.
+
+        The same client is not given the image again for RELEASE_COOLDOWN seconds.
+        """
+        with self.lock:
+            lease = self.leases.pop(lease_id, None)
+            if lease:
+                self.released[(lease["client"], lease["image"])] = time.monotonic()
+        if lease:
+            self.watcher.queue.requeue(lease["image"])
+
+    def image_data(self, lease_id: str) -> bytes:
+        with self.lock:
+            image = self._get_lease(lease_id)["image"]
+        return image.read_bytes()
+
+    def submit(self, lease_id: str, metadata: list, people: list[dict]) -> str:
+        """Write the metadata file for a leased image and end the lease.
+
+        The lease is kept if the data is malformed or the file can not be written.
+        """
+        metadata = fields_from_json(metadata)
+        people = [person_from_json(person) for person in people]
+        with self.lock:
+            lease = self._get_lease(lease_id)
+        image = lease["image"]
+        try:
+            digest = lease["digest"].result()
+        except OSError:
+            digest = None
+        meta_file = save_info(image, metadata, people, digest)
+        with self.lock:
+            self.leases.pop(lease_id, None)
+        self.watcher.queue.done(image)
+        self.submitted += 1
+        return str(meta_file)
+
+    def status(self) -> dict:
+        self.expire_leases()
+        with self.lock:
+            leases = [
+                {"image": str(lease["image"]), "client": lease["client"]}
+                for lease in self.leases.values()
+            ]
+        return {
+            "queued": len(self.watcher.queue),
+            "submitted": self.submitted,
+            "leases": leases,
+            "roots": [
+                dict(root.to_dict(), stats=root.stats) for root in self.watcher.roots
+            ],
+        }
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    daemon: AnnotationDaemon
+
+    def send_json(self, data, status: int = 200):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/status":
+            self.send_json(self.daemon.status())
+        elif url.path == "/image":
+            lease_id = parse_qs(url.query).get("lease", [""])[0]
+            try:
+                data = self.daemon.image_data(lease_id)
+            except (LeaseError, OSError) as error:
+                self.send_json({"error": str(error)}, 404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.send_json({"error": "Not found"}, 404)
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(request, dict):
+                raise ValueError("Expected a JSON object")
+            if self.path == "/lease":
+                self.send_json({"lease": self.daemon.lease(request.get("client", ""))})
+            elif self.path == "/renew":
+                self.daemon.renew(request["lease"])
+                self.send_json({})
+            elif self.path == "/release":
+                self.daemon.release(request["lease"])
+                self.send_json({})
+            elif self.path == "/submit":
+                meta_file = self.daemon.submit(
+                    request["lease"], request["metadata"], request.get("people", [])
+                )
+                self.send_json({"meta_file": meta_file})
+            else:
+                self.send_json({"error": "Not found"}, 404)
+        except LeaseError as error:
+            self.send_json({"error": str(error)}, 409)
+        except (KeyError, TypeError, ValueError, OSError) as error:
+            self.send_json({"error": str(error)}, 400)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(daemon: AnnotationDaemon, host: str = "127.0.0.1", port: int = DEFAULT_PORT):
+    handler = type("Handler", (DaemonRequestHandler,), {"daemon": daemon})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+class DaemonClient:
+    """Talks to an AnnotationDaemon over HTTP, raises LeaseError when a lease was lost"""
+
+    def __init__(self, url: str, client: str = ""):
+        self.url = url.rstrip("/")
+        self.client = client
+
+    def _post(self, path: str, data: dict) -> dict:
+        request = Request(
+            self.url + path,
+            data=json.dumps(data, ensure_ascii=False).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        try:
+            with urlopen(request, timeout=10) as response:
+                return json.loads(response.read())
+        except OSError as error:
+            if getattr(error, "code", None) == 409:
+                raise LeaseError(json.loads(error.read())["error"]) from error
+            raise
+
+    def lease(self) -> dict | None:
+        return self._post("/lease", {"client": self.client})["lease"]
+
+    def renew(self, lease_id: str):
+        self._post("/renew", {"lease": lease_id})
+
+    def release(self, lease_id: str):
+        self._post("/release", {"lease": lease_id})
+
+    def image_data(self, lease_id: str) -> bytes:
+        with urlopen(f"{self.url}/image?lease={lease_id}", timeout=30) as response:
+            return response.read()
+
+    def submit(self, lease_id: str, metadata: list, people: list[dict]) -> str:
+        data = {"lease": lease_id, "metadata": metadata, "people": people}
+        return self._post("/submit", data)["meta_file"]
+
+
+class LocalDaemonClient:
+    """Same interface as DaemonClient but calls a daemon in the same process, for testing without a server"""
+
+    def __init__(self, daemon: AnnotationDaemon, client: str = ""):
+        self.daemon = daemon
+        self.client = client
+
+    def lease(self) -> dict | None:
+        return self.daemon.lease(self.client)
+
+    def renew(self, lease_id: str):
+        self.daemon.renew(lease_id)
+
+    def release(self, lease_id: str):
+        self.daemon.release(lease_id)
+
+    def image_data(self, lease_id: str) -> bytes:
+        return self.daemon.image_data(lease_id)
+
+    def submit(self, lease_id: str, metadata: list, people: list[dict]) -> str:
+        # the same copy a request would make, so the caller's lists are not changed
+        metadata, people = json.loads(json.dumps([metadata, people]))
+        return self.daemon.submit(lease_id, metadata, people)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Släktskanning annotation server")
+    parser.add_argument(
+        "folders", nargs="*", help="folders to watch, defaults to the config"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--lease-timeout", type=float, default=LEASE_TIMEOUT)
+    args = parser.parse_args()
+
+    roots = [WatchRoot(folder) for folder in args.folders] or load_watch_roots()
+    roots = [root for root in roots if root.path.exists()]
+    if not roots:
+        parser.error("no existing folder to watch")
+
+    daemon = AnnotationDaemon(roots, args.lease_timeout)
+    daemon.start()
+    server = serve(daemon, args.host, args.port)
+    print(f"Listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,408 @@
+"""Static HTML gallery of an annotated archive, for browsing who is in which photo.
+
+Every image gets a page where the tagged people are clickable markers, every person a
+page with the images they are in, and a client side search covers places, dates,
+descriptions and names. Thumbnails are made in a process pool (needs Pillow, the full
+images are shown otherwise).
+
+Rebuilding is incremental: only images or metadata files whose size or modification
+time changed are read again and only pages whose content changed are written.
+
+    python gallery.py <archive folder> <gallery folder> [--jobs 4]
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import html
+import json
+import os
+from pathlib import Path
+import time
+
+from metadata import load_info, person_key, sidecar_path
+from scanning import IMAGE_EXTENSIONS
+
+
+STATE_NAME = ".galleri.json"
+THUMBNAIL_SIZE = 300
+PAGE_SIZE = 200
+
+# image fields shown on the image page, in this order
+SHOWN_FIELDS = {
+    "datum_taget": "Datum",
+    "plats": "Plats",
+    "fotograf": "Fotograf",
+    "källa": "Källa",
+    "sammanhang": "Sammanhang",
+    "nyckelord": "Nyckelord",
+    "beskrivning": "Beskrivning",
+    "anteckningar": "Anteckningar",
+}
+
+STYLE = """
+body { font-family: sans-serif; margin: 1em 2em; }
+nav a { margin-right: 1em; }
+.grid { display: flex; flex-wrap: wrap; gap: 8px; }
+.grid a { display: block; width: 160px; text-align: center; font-size: small; }
+.grid img { max-width: 160px; max-height: 160px; }
+.photo { position: relative; display: inline-block; }
+/* the markers were placed on the image as stored, without EXIF rotation */
+.photo img { max-width: 100%; max-height: 85vh; image-orientation: none; }
+.marker { position: absolute; width: 14px; height: 14px; margin: -7px 0 0 -7px;
+  border: 2px solid black; border-radius: 50%; background: red; }
+dt { font-weight: bold; margin-top: 0.5em; }
+"""
+
+SEARCH_SCRIPT = """
+const box = document.getElementById("sok");
+const results = document.getElementById("resultat");
+box.addEventListener("input", () => {
+  const words = box.value.toLowerCase().split(/\\s+/).filter(Boolean);
+  results.innerHTML = "";
+  if (!words.length) return;
+  for (const [text, url, title] of SEARCH_INDEX) {
+    if (words.every((word) => text.includes(word))) {
+      const item = document.createElement("li");
+      const link = document.createElement("a");
+      link.href = url;
+      link.textContent = title;
+      item.appendChild(link);
+      results.appendChild(item);
+      if (results.children.length >= 200) break;
+    }
+  }
+});
+"""
+
+
+def short_id(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def pillow_available() -> bool:
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def make_thumbnail(image: str, thumbnail: str, size: int = THUMBNAIL_SIZE) -> bool:
+    """Write a JPEG thumbnail, run in a worker process. False if Pillow is missing"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return False
+    with Image.open(image) as picture:
+        picture.thumbnail((size, size))
+        picture.convert("RGB").save(thumbnail, "JPEG", quality=85)
+    return True
+
+
+def person_name(metadata) -> str:
+    person = dict(metadata)
+    name = f"{person.get('förnamn', '')} {person.get('efternamn', '')}".strip()
+    if not name:
+        return "Okänd person"
+    if person.get("födelsedatum"):
+        name += f" ({person['födelsedatum']})"
+    return name
+
+
+def read_record(image: Path, relative: str) -> dict:
+    """What the gallery needs to know about one image and its metadata file"""
+    record = {"path": relative, "id": short_id(relative), "fields": {}, "people": []}
+    try:
+        info = load_info(sidecar_path(image))
+    except (OSError, ValueError):
+        return record
+    record["fields"] = {key: info[key] for key in SHOWN_FIELDS if info.get(key)}
+    for person in info["personer"]:
+        key = person_key(person["metadata"])
+        record["people"].append(
+            {
+                "coordinates": person["coordinates"],
+                "name": person_name(person["metadata"]),
+                "id": short_id(key) if key.strip("|") else None,
+            }
+        )
+    return record
+
+
+def signature(image: Path) -> list:
+    stat = image.stat()
+    try:
+        meta_mtime = sidecar_path(image).stat().st_mtime_ns
+    except OSError:
+        meta_mtime = None
+    return [stat.st_size, stat.st_mtime_ns, meta_mtime]
+
+
+def page(title: str, body: str, depth: int = 0) -> str:
+    root = "../" * depth
+    return f"""<!DOCTYPE html>
+<html lang="sv">
+<head>
+<meta charset="utf-8">
+<title>{html.escape(title)}</title>
+<link rel="stylesheet" href="{root}stil.css">
+</head>
+<body>
+<nav><a href="{root}index.html">Bilder</a><a href="{root}personer/index.html">Personer</a><a href="{root}sok.html">Sök</a></nav>
+<h1>{html.escape(title)}</h1>
+{body}
+</body>
+</html>
+"""
+
+
+class Gallery:
+    def __init__(self, archive: Path, output: Path, jobs: int | None = None):
+        self.archive = archive.resolve()
+        self.output = output.resolve()
+        self.jobs = jobs
+        self.state_path = self.output / STATE_NAME
+        try:
+            self.state = json.loads(self.state_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            self.state = {}
+        # relative image path -> {"signature": [...], "record": {...}, "thumbnail": bool}
+        self.images: dict[str, dict] = self.state.get("images", {})
+        # written file -> hash of its content
+        self.pages: dict[str, str] = self.state.get("pages", {})
+        # files that belong to the gallery built now, the other pages are removed
+        self.current: set[str] = set()
+        self.written = 0
+
+    def write(self, relative: str, text: str):
+        """Write a file of the gallery, unless it already has exactly this content"""
+        digest = short_id(text)
+        path = self.output / relative
+        self.current.add(relative)
+        if self.pages.get(relative) == digest and path.exists():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text, encoding="utf-8")
+        self.pages[relative] = digest
+        self.written += 1
+
+    def remove(self, relative: str):
+        self.pages.pop(relative, None)
+        (self.output / relative).unlink(missing_ok=True)
+
+    def image_url(self, entry: dict, depth: int) -> str:
+        """Relative link from a page depth folders deep to the original image"""
+        image = self.archive / entry["record"]["path"]
+        return Path(os.path.relpath(image, self.output / ("x/" * depth))).as_posix()
+
+    def thumbnail_url(self, entry: dict, depth: int) -> str:
+        if entry.get("thumbnail"):
+            return "../" * depth + f"miniatyrer/{entry['record']['id']}.jpg"
+        return self.image_url(entry, depth)
+
+    def scan(self) -> list[str]:
+        """Update the records of changed images, returns the ones needing a thumbnail"""
+        found = set()
+        changed = []
+        for image in self.archive.glob("**/*"):
+            if (
+                image.suffix.lower() not in IMAGE_EXTENSIONS
+                or self.output in image.parents
+                or not image.is_file()
+            ):
+                continue
+            relative = image.relative_to(self.archive).as_posix()
+            found.add(relative)
+            current = signature(image)
+            entry = self.images.get(relative)
+            if entry and entry["signature"] == current:
+                continue
+            image_changed = not entry or entry["signature"][:2] != current[:2]
+            self.images[relative] = {
+                "signature": current,
+                "record": read_record(image, relative),
+                "thumbnail": entry.get("thumbnail", False) if entry else False,
+            }
+            if image_changed:
+                changed.append(relative)
+
+        for relative in set(self.images) - found:
+            entry = self.images.pop(relative)
+            self.remove(f"bilder/{entry['record']['id']}.html")
+            (self.output / f"miniatyrer/{entry['record']['id']}.jpg").unlink(
+                missing_ok=True
+            )
+        return changed
+
+    def make_thumbnails(self, relatives: list[str]):
+        (self.output / "miniatyrer").mkdir(parents=True, exist_ok=True)
+        with ProcessPoolExecutor(self.jobs) as pool:
+            futures = {
+                relative: pool.submit(
+                    make_thumbnail,
+                    str(self.archive / relative),
+                    str(
+                        self.output
+                        / f"miniatyrer/{self.images[relative]['record']['id']}.jpg"
+                    ),
+                )
+                for relative in relatives
+            }
+            for relative, future in futures.items():
+                try:
+                    self.images[relative]["thumbnail"] = future.result()
+                except Exception as error:
+                    print(f"No thumbnail for {relative}: {error}")
+                    self.images[relative]["thumbnail"] = False
+
+    def thumbnail_grid(self, entries: list[dict], depth: int) -> str:
+        items = []
+        for entry in entries:
+            record = entry["record"]
+            caption = record["fields"].get("datum_taget") or Path(record["path"]).name
+            items.append(
+                f'<a href="{"../" * depth}bilder/{record["id"]}.html">'
+                f'<img src="{html.escape(self.thumbnail_url(entry, depth))}" loading="lazy" alt="">'
+                f"<br>{html.escape(caption)}</a>"
+            )
+        return '<div class="grid">\n' + "\n".join(items) + "\n</div>"
+
+    def image_page(self, entry: dict) -> str:
+        record = entry["record"]
+        markers = []
+        names = []
+        for person in record["people"]:
+            x, y = person["coordinates"]
+            if x is None or y is None:
+                continue
+            name = html.escape(person["name"])
+            href = f'../personer/{person["id"]}.html' if person["id"] else "#"
+            markers.append(
+                f'<a class="marker" href="{href}" title="{name}" '
+                f'style="left: {x * 100:.2f}%; top: {y * 100:.2f}%"></a>'
+            )
+            names.append(f'<li><a href="{href}">{name}</a></li>')
+        fields = "".join(
+            f"<dt>{label}</dt><dd>{html.escape(record['fields'][key])}</dd>"
+            for key, label in SHOWN_FIELDS.items()
+            if key in record["fields"]
+        )
+        body = (
+            f'<div class="photo"><img src="{html.escape(self.image_url(entry, 1))}" alt="">'
+            + "".join(markers)
+            + f"</div>\n<ul>{''.join(names)}</ul>\n<dl>{fields}</dl>"
+        )
+        return page(Path(record["path"]).name, body, depth=1)
+
+    def build(self):
+        started = time.perf_counter()
+        changed = self.scan()
+        has_pillow = pillow_available()
+        # a failed thumbnail is only tried again when its image changes, or all of
+        # them once when Pillow was installed since the last build
+        retry = []
+        if has_pillow and not self.state.get("pillow"):
+            retry = [
+                relative
+                for relative, entry in self.images.items()
+                if not entry["thumbnail"] and relative not in changed
+            ]
+        if has_pillow and (changed or retry):
+            self.make_thumbnails(changed + retry)
+        elif not has_pillow:
+            for relative in changed:
+                self.images[relative]["thumbnail"] = False
+
+        entries = sorted(
+            self.images.values(), key=lambda entry: entry["record"]["path"]
+        )
+        people: dict[str, dict] = {}
+        search_index = []
+        for entry in entries:
+            record = entry["record"]
+            self.write(f"bilder/{record['id']}.html", self.image_page(entry))
+            names = []
+            for person in record["people"]:
+                names.append(person["name"])
+                if person["id"]:
+                    people.setdefault(
+                        person["id"], {"name": person["name"], "entries": []}
+                    )["entries"].append(entry)
+            text = " ".join(list(record["fields"].values()) + names + [record["path"]])
+            title = record["fields"].get("datum_taget", "") + " " + record["path"]
+            search_index.append(
+                [text.lower(), f"bilder/{record['id']}.html", title.strip()]
+            )
+
+        for person_id, person in people.items():
+            grid = self.thumbnail_grid(person["entries"], depth=1)
+            self.write(f"personer/{person_id}.html", page(person["name"], grid, 1))
+            search_index.append(
+                [person["name"].lower(), f"personer/{person_id}.html", person["name"]]
+            )
+        people_list = "".join(
+            f'<li><a href="{person_id}.html">{html.escape(person["name"])}</a>'
+            f' ({len(person["entries"])})</li>'
+            for person_id, person in sorted(
+                people.items(), key=lambda item: item[1]["name"].lower()
+            )
+        )
+        self.write(
+            "personer/index.html", page("Personer", f"<ul>{people_list}</ul>", 1)
+        )
+
+        pages = [entries[i : i + PAGE_SIZE] for i in range(0, len(entries), PAGE_SIZE)]
+        for number, page_entries in enumerate(pages or [[]], start=1):
+            links = " ".join(
+                f'<a href="{"index" if n == 1 else f"index-{n}"}.html">{n}</a>'
+                for n in range(1, len(pages) + 1)
+            )
+            body = self.thumbnail_grid(page_entries, 0) + f"\n<p>{links}</p>"
+            name = "index.html" if number == 1 else f"index-{number}.html"
+            self.write(name, page("Bilder", body))
+
+        self.write("stil.css", STYLE)
+        self.write(
+            "sok.js",
+            "const SEARCH_INDEX = "
+            + json.dumps(search_index, ensure_ascii=False)
+            + ";\n"
+            + SEARCH_SCRIPT,
+        )
+        self.write(
+            "sok.html",
+            page(
+                "Sök",
+                '<input id="sok" type="search" autofocus placeholder="Namn, plats, år...">'
+                '<ul id="resultat"></ul><script src="sok.js"></script>',
+            ),
+        )
+
+        # people no longer in any sidecar and index pages past the last one
+        for relative in set(self.pages) - self.current:
+            self.remove(relative)
+
+        self.state = {"images": self.images, "pages": self.pages, "pillow": has_pillow}
+        tmp_path = self.state_path.with_suffix(".tmp")
+        tmp_path.write_text(
+            json.dumps(self.state, ensure_ascii=False), encoding="utf-8"
+        )
+        tmp_path.replace(self.state_path)
+        print(
+            f"{len(entries)} images, {len(changed)} new or changed, "
+            f"{self.written} files written in {time.perf_counter() - started:.1f} s"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("archive", type=Path)
+    parser.add_argument("output", type=Path)
+    parser.add_argument("--jobs", type=int, help="processes making thumbnails")
+    args = parser.parse_args()
+    Gallery(args.archive, args.output, args.jobs).build()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+"""Index of the people in a family tree exported from Disgen (or any other program) as GEDCOM.
+
+The file is read one line at a time and only one person is kept in memory, so trees
+with hundreds of thousands of people can be imported. The index is an SQLite database
+searched by name, dates, places and PersonID, and it is used in the person dialogs to
+fill in the person in one step.
+
+Importing the same file again only writes the people that changed and removes the ones
+no longer in the file.
+
+    python gedcom.py <tree.ged>
+"""
+
+import argparse
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from util import app_data_path
+
+INDEX_PATH = app_data_path("slaktskanning_slakttrad.sqlite")
+
+# person fields from PEOPLE_METADATA that are filled in from the tree
+TREE_FIELDS = [
+    "förnamn",
+    "efternamn",
+    "personidentitet",
+    "födelsedatum",
+    "födelseort",
+    "dödsdatum",
+    "dödsort",
+]
+
+MONTHS = {
+    month: number
+    for number, month in enumerate(
+        [
+            "JAN",
+            "FEB",
+            "MAR",
+            "APR",
+            "MAY",
+            "JUN",
+            "JUL",
+            "AUG",
+            "SEP",
+            "OCT",
+            "NOV",
+            "DEC",
+        ],
+        start=1,
+    )
+}
+
+# value of 1 CHAR in the header -> Python codec, anything else is read as UTF-8
+ENCODINGS = {"ANSI": "cp1252", "WINDOWS": "cp1252", "IBMPC": "cp850"}
+
+# (event, tag) -> person field
+EVENT_FIELDS = {
+    ("BIRT", "DATE"): "födelsedatum",
+    ("BIRT", "PLAC"): "födelseort",
+    ("DEAT", "DATE"): "dödsdatum",
+    ("DEAT", "PLAC"): "dödsort",
+}
+
+LINE_PATTERN = re.compile(r"\s*(\d+)\s+(@[^@]+@\s+)?(\S+)\s?(.*)")
+
+
+def gedcom_date(value: str) -> str:
+    """A GEDCOM date like "12 MAR 1920" as 1920-03-12, other dates ("ABT 1920") as they are"""
+    parts = value.upper().split()
+    if (
+        len(parts) == 3
+        and parts[1] in MONTHS
+        and parts[0].isdigit()
+        and parts[2].isdigit()
+    ):
+        return f"{parts[2]}-{MONTHS[parts[1]]:02}-{int(parts[0]):02}"
+    if len(parts) == 2 and parts[0] in MONTHS and parts[1].isdigit():
+        return f"{parts[1]}-{MONTHS[parts[0]]:02}"
+    return value.strip()
+
+
+def detect_encoding(path: Path) -> str:
+    with open(path, "rb") as file:
+        if file.read(3) == b"\xef\xbb\xbf":
+            return "utf-8-sig"
+        file.seek(0)
+        for line in file:
+            if line.startswith(b"0 @"):
+                break
+            match = re.match(rb"\s*1\s+CHAR\s+(\S+)", line)
+            if match:
+                return ENCODINGS.get(match.group(1).decode("ascii").upper(), "utf-8")
+    return "utf-8"
+
+
+def person_from_lines(xref: str, lines: list[tuple[int, str, str]]) -> dict:
+    """Fields of one INDI record from its (level, tag, value) lines"""
+    person = {"xref": xref}
+    path = []
+    for level, tag, value in lines:
+        del path[level - 1 :]
+        path.append(tag)
+        if path == ["NAME"] and "förnamn" not in person:
+            given, _, rest = value.partition("/")
+            person["förnamn"] = given.strip()
+            person["efternamn"] = rest.partition("/")[0].strip()
+        elif path == ["REFN"] and value.strip():
+            person["personidentitet"] = value.strip()
+        elif tuple(path) in EVENT_FIELDS:
+            field = EVENT_FIELDS[tuple(path)]
+            value = gedcom_date(value) if path[1] == "DATE" else value.strip()
+            person.setdefault(field, value)
+    if "personidentitet" not in person:
+        # Disgen writes its PersonID as the record id, @I123@
+        digits = re.sub(r"\D", "", xref)
+        if digits:
+            person["personidentitet"] = digits
+    return person
+
+
+def iter_people(path: Path):
+    """Yield (fields, digest) for every person in a GEDCOM file, reading one record at a time"""
+    xref = None
+    lines = []
+    digest = None
+    with open(path, encoding=detect_encoding(path), errors="replace") as file:
+        for line in file:
+            match = LINE_PATTERN.match(line)
+            if not match:
+                continue
+            level = int(match.group(1))
+            if level == 0:
+                if xref:
+                    yield person_from_lines(xref, lines), digest.hexdigest()
+                xref = None
+                if match.group(3) == "INDI" and match.group(2):
+                    xref = match.group(2).strip()
+                    lines = []
+                    digest = hashlib.blake2b(digest_size=16)
+            elif xref:
+                lines.append((level, match.group(3), match.group(4)))
+                digest.update(line.strip().encode("utf-8"))
+        if xref:
+            yield person_from_lines(xref, lines), digest.hexdigest()
+
+
+def split_words(text: str) -> set[str]:
+    return {word for word in re.split(r"[\s,/()]+", text.lower()) if word}
+
+
+def search_terms(person: dict) -> set[str]:
+    return split_words(" ".join(person.get(field, "") for field in TREE_FIELDS))
+
+
+class FamilyTree:
+    """The SQLite index of a family tree. Searching is done from the thread that created it"""
+
+    def __init__(self, path: Path = INDEX_PATH):
+        self.path = Path(path)
+        self.connection = self.connect()
+        # number of people, counted once and updated by imports, as it is read on
+        # every dialog open
+        self.people_count = self.connection.execute(
+            "SELECT count(*) FROM people"
+        ).fetchone()[0]
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path)
+        # readers are not blocked while another thread imports
+        connection.execute("PRAGMA journal_mode=WAL")
+        columns = ", ".join(f'"{field}" TEXT' for field in TREE_FIELDS)
+        connection.executescript(f"""
+            CREATE TABLE IF NOT EXISTS people (
+                xref TEXT PRIMARY KEY, {columns}, digest TEXT, generation INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS terms (term TEXT, xref TEXT);
+            CREATE INDEX IF NOT EXISTS terms_term ON terms (term);
+            CREATE INDEX IF NOT EXISTS terms_xref ON terms (xref, term);
+            CREATE TABLE IF NOT EXISTS source (key TEXT PRIMARY KEY, value TEXT);
+            """)
+        return connection
+
+    def __len__(self):
+        return self.people_count
+
+    def import_file(self, gedcom_path: Path, force: bool = False) -> dict:
+        """Update the index from a GEDCOM file, returns the number of added, changed and removed people.
+
+        Uses its own connection, so it can run in a background thread.
+        """
+        gedcom_path = Path(gedcom_path)
+        stat = gedcom_path.stat()
+        stamp = f"{gedcom_path.resolve()}|{stat.st_size}|{stat.st_mtime_ns}"
+        counts = {"added": 0, "changed": 0, "removed": 0, "people": 0}
+        connection = self.connect()
+        try:
+            row = connection.execute(
+                "SELECT value FROM source WHERE key = 'file'"
+            ).fetchone()
+            if row and row[0] == stamp and not force:
+                counts["people"] = connection.execute(
+                    "SELECT count(*) FROM people"
+                ).fetchone()[0]
+                return counts
+            generation = connection.execute(
+                "SELECT coalesce(max(generation), 0) + 1 FROM people"
+            ).fetchone()[0]
+            columns = ", ".join(f'"{field}"' for field in TREE_FIELDS)
+            placeholders = ", ".join("?" for _ in TREE_FIELDS)
+            with connection:
+                for person, digest in iter_people(gedcom_path):
+                    counts["people"] += 1
+                    xref = person["xref"]
+                    row = connection.execute(
+                        "SELECT digest FROM people WHERE xref = ?", (xref,)
+                    ).fetchone()
+                    if row and row[0] == digest:
+                        connection.execute(
+                            "UPDATE people SET generation = ? WHERE xref = ?",
+                            (generation, xref),
+                        )
+                        continue
+                    counts["changed" if row else "added"] += 1
+                    connection.execute(
+                        f"INSERT OR REPLACE INTO people (xref, {columns}, digest, generation)"
+                        f" VALUES (?, {placeholders}, ?, ?)",
+                        [xref]
+                        + [person.get(field, "") for field in TREE_FIELDS]
+                        + [digest, generation],
+                    )
+                    connection.execute("DELETE FROM terms WHERE xref = ?", (xref,))
+                    connection.executemany(
+                        "INSERT INTO terms (term, xref) VALUES (?, ?)",
+                        [(term, xref) for term in search_terms(person)],
+                    )
+                counts["removed"] = connection.execute(
+                    "SELECT count(*) FROM people WHERE generation != ?", (generation,)
+                ).fetchone()[0]
+                connection.execute(
+                    "DELETE FROM terms WHERE xref IN"
+                    " (SELECT xref FROM people WHERE generation != ?)",
+                    (generation,),
+                )
+                connection.execute(
+                    "DELETE FROM people WHERE generation != ?", (generation,)
+                )
+                connection.execute(
+                    "INSERT OR REPLACE INTO source (key, value) VALUES ('file', ?)",
+                    (stamp,),
+                )
+            self.people_count = connection.execute(
+                "SELECT count(*) FROM people"
+            ).fetchone()[0]
+        finally:
+            connection.close()
+        return counts
+
+    def import_in_background(self, gedcom_path: Path, on_done=None):
+        """Import from a daemon thread, on_done(counts or None) is called from that thread"""
+
+        def run():
+            try:
+                counts = self.import_file(gedcom_path)
+            except (OSError, sqlite3.Error) as error:
+                print(f"Could not import {gedcom_path}: {error}")
+                counts = None
+            if on_done:
+                on_done(counts)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def search(self, text: str, limit: int = 20) -> list[dict]:
+        """People where every word of text is the start of a name, date, place or PersonID"""
+        words = split_words(text)
+        if not words:
+            return []
+        # the word matching the fewest terms picks the candidates, the others are
+        # checked per candidate, so a common word like a parish does not scan everything
+        counts = {
+            word: self.connection.execute(
+                "SELECT count(*) FROM (SELECT 1 FROM terms"
+                " WHERE term >= ? AND term < ? LIMIT 1000)",
+                (word, word + "\uffff"),
+            ).fetchone()[0]
+            for word in words
+        }
+        first, *others = sorted(words, key=counts.get)
+        conditions = "".join(
+            " AND EXISTS (SELECT 1 FROM terms AS other WHERE other.xref = terms.xref"
+            " AND other.term >= ? AND other.term < ?)"
+            for _ in others
+        )
+        parameters = [first, first + "\uffff"]
+        for word in others:
+            parameters += [word, word + "\uffff"]
+        columns = ", ".join(f'people."{field}"' for field in TREE_FIELDS)
+        rows = self.connection.execute(
+            f"SELECT DISTINCT people.xref, {columns} FROM terms"
+            " JOIN people ON people.xref = terms.xref"
+            f" WHERE terms.term >= ? AND terms.term < ?{conditions} LIMIT ?",
+            parameters + [limit],
+        ).fetchall()
+        rows.sort(key=lambda row: (row[2], row[1], row[4]))
+        return [
+            {field: value for field, value in zip(TREE_FIELDS, row[1:]) if value}
+            for row in rows
+        ]
+
+
+def tree_label(person: dict) -> str:
+    """How a person from the tree is shown in search results"""
+    years = f"{person.get('födelsedatum', '')}–{person.get('dödsdatum', '')}"
+    label = f"{person.get('förnamn', '')} {person.get('efternamn', '')} ({years.strip('–')})"
+    if person.get("födelseort"):
+        label += f", {person['födelseort']}"
+    if person.get("personidentitet"):
+        label += f" [{person['personidentitet']}]"
+    return label
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("gedcom", type=Path)
+    parser.add_argument(
+        "--force", action="store_true", help="read the file even if it has not changed"
+    )
+    args = parser.parse_args()
+    started = time.perf_counter()
+    counts = FamilyTree().import_file(args.gedcom, args.force)
+    print(
+        f"{counts['people']} people, {counts['added']} added, {counts['changed']} changed, "
+        f"{counts['removed']} removed in {time.perf_counter() - started:.1f} s"
+    )
+
+
+if __name__ == "__main__":
+    main()
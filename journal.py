@@ -0,0 +1,111 @@
+import json
+import os
+from pathlib import Path
+import time
+
+from util import app_data_path
+
+JOURNAL_PATH = app_data_path("slaktskanning_journal.jsonl")
+
+
+class AnnotationJournal:
+    """Append-only log of the edits to the image being annotated, to survive a crash before Submit.
+
+    Every edit is written and flushed right away, but only synced to disk at most once per
+    sync_interval, call sync to force it. Starting a new image or writing its metadata file
+    truncates the journal, so it only ever holds one session.
+    """
+
+    sync_interval = 1.0
+
+    def __init__(self, path: Path = JOURNAL_PATH):
+        self.path = Path(path)
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.last_sync = 0.0
+        self.dirty = False
+
+    def append(self, record: dict):
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+        self.dirty = True
+        if time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        if self.dirty:
+            os.fsync(self.file.fileno())
+            self.dirty = False
+            self.last_sync = time.monotonic()
+
+    def truncate(self):
+        self.file.truncate(0)
+        self.dirty = True
+        self.sync()
+
+    def begin(self, image):
+        self.truncate()
+        self.append({"op": "begin", "image": str(image)})
+
+    def moved(self, image):
+        """The image being annotated was renamed or moved"""
+        self.append({"op": "move", "image": str(image)})
+
+    def set_field(self, key: str, value: str):
+        self.append({"op": "field", "key": key, "value": value})
+
+    def set_person(self, coordinates, metadata):
+        self.append({"op": "person", "coordinates": coordinates, "metadata": metadata})
+
+    def remove_person(self, coordinates):
+        self.append({"op": "remove", "coordinates": coordinates})
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+    @staticmethod
+    def replay(path: Path = JOURNAL_PATH) -> dict | None:
+        """State of the journaled session, or None if nothing was entered.
+
+        Returns {"image": str, "fields": {key: text}, "people": [...]} with people in the
+        same shape as PhotoMetaApp.people.
+        """
+        try:
+            lines = Path(path).read_text(encoding="utf-8").splitlines()
+        except OSError:
+            return None
+
+        session = None
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line may be cut off by the crash
+                break
+            op = record.get("op")
+            if op == "begin":
+                session = {"image": record["image"], "fields": {}, "people": {}}
+            elif session is None:
+                continue
+            elif op == "move":
+                session["image"] = record["image"]
+            elif op == "field":
+                session["fields"][record["key"]] = record["value"]
+            elif op == "person":
+                coordinates = tuple(record["coordinates"])
+                session["people"][coordinates] = {
+                    "coordinates": coordinates,
+                    "metadata": [tuple(field) for field in record["metadata"]],
+                }
+            elif op == "remove":
+                session["people"].pop(tuple(record["coordinates"]), None)
+
+        if session is None:
+            return None
+        session["fields"] = {
+            key: text for key, text in session["fields"].items() if text
+        }
+        session["people"] = list(session["people"].values())
+        if not session["fields"] and not session["people"]:
+            return None
+        return session
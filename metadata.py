@@ -1,7 +1,10 @@
 from datetime import datetime
+import glob
 from pathlib import Path
 import hashlib
 import json
+import os
+import re
 from typing import Any
 
 from meta_schema import METADATA_SCHEMA, PEOPLE_METADATA
@@ -20,6 +23,27 @@ def dict_hash(dictionary: dict[str, Any]) -> str:
 metadata_hash = dict_hash(METADATA_SCHEMA)
 people_metadata_hash = dict_hash(PEOPLE_METADATA)
 
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path) -> str:
+    """BLAKE2b hash of a file, read in chunks so large scans are never in memory at once"""
+    digest = hashlib.blake2b()
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as file:
+        while size := file.readinto(buffer):
+            digest.update(view[:size])
+    return digest.hexdigest()
+
+
+def escape_filename(name: str) -> str:
+    return name.replace(" #", " <hashtag>")
+
+
+def unescape_filename(name: str) -> str:
+    return name.replace(" <hashtag>", " #")
+
 
 def format_field(key: str, text: str, comment: str, indentation: int = 0) -> str:
     indent = " " * indentation
@@ -42,12 +66,24 @@ def format_field(key: str, text: str, comment: str, indentation: int = 0) -> str
 
 
 def save_info(
-    image_path, metadata: list[tuple[str, str]], people: list[dict] | None = None
+    image_path,
+    metadata: list[tuple[str, str]],
+    people: list[dict] | None = None,
+    digest: str | None = None,
 ):
+    """Write the metadata file next to the image.
+
+    digest is the file_digest of the image if it was already computed in the background.
+    """
     image = Path(image_path)
     image_stat = image.stat()
     now = datetime.now().astimezone()
-    created_date = datetime.fromtimestamp(image_stat.st_ctime).astimezone()
+    # st_ctime is the change time, not the creation time, outside of Windows
+    created_date = datetime.fromtimestamp(
+        getattr(image_stat, "st_birthtime", image_stat.st_ctime)
+    ).astimezone()
+    if digest is None:
+        digest = file_digest(image)
     metadata = dict(metadata)
 
     metadata_text = f"""
@@ -61,7 +97,7 @@ def save_info(
 ###############################################
 
 # Filnamn på den inskannade bilden
-filnamn: {image.name.replace(" #", " <hashtag>")}
+filnamn: {escape_filename(image.name)}
 
 # Datum och tid då metadata skrevs
 metadata_skriven: {now.strftime('%Y-%m-%d %H:%M:%S GMT%z')}
@@ -72,6 +108,9 @@ bildfilen_skapad: {created_date.strftime('%Y-%m-%d %H:%M:%S GMT%z')}
 # Bildfilens storlek i byte
 bildfilen_storlek_byte: {image_stat.st_size}
 
+# BLAKE2b-kontrollsumma av bildfilen
+bildfilen_blake2b: {digest}
+
 # Metadata version
 metadata_version: {metadata_hash}
 
@@ -144,7 +183,13 @@ personer:
         text = metadata.get(key, "").strip()
         metadata_text += format_field(key, text, comment)
 
-    meta_file = image.with_stem(image.stem + "_metadata").with_suffix(".yaml")
+    meta_file = sidecar_path(image)
+    # write to a temporary file first so a crash never leaves a half written metadata file
+    tmp_file = meta_file.with_suffix(".yaml.tmp")
+    with open(tmp_file, "w", encoding="utf-8") as file:
+        file.write(metadata_text)
+        file.flush()
+        os.fsync(file.fileno())
     if meta_file.exists():
         modified_date = datetime.fromtimestamp(meta_file.stat().st_mtime)
         meta_file.rename(
@@ -152,4 +197,154 @@ personer:
                 f"{meta_file.stem}_{modified_date.strftime('%Y-%m-%d_%H-%M-%S')}"
             )
         )
-    meta_file.write_text(metadata_text, encoding="utf-8")
+    os.replace(tmp_file, meta_file)
+    return meta_file
+
+
+def person_label(metadata) -> str:
+    """How a tagged person is shown in menus and search results"""
+    person = dict(metadata)
+    return f"{person.get('förnamn', '')} {person.get('efternamn', '')} ({person.get('födelsedatum', '')})"
+
+
+def person_key(metadata) -> str:
+    """Identity of a tagged person, the same fields that are used to deduplicate recent people"""
+    person = dict(metadata)
+    return "|".join(
+        person.get(key, "").strip().lower()
+        for key in ("förnamn", "efternamn", "födelsedatum")
+    )
+
+
+def is_sidecar(path: Path) -> bool:
+    """Current metadata file, not one of the timestamped revisions left by save_info"""
+    return path.suffix == ".yaml" and path.stem.endswith("_metadata")
+
+
+def sidecar_path(image) -> Path:
+    image = Path(image)
+    return image.with_stem(image.stem + "_metadata").with_suffix(".yaml")
+
+
+def sidecar_image(meta_file, info: dict) -> Path:
+    """The image a metadata file read with load_info describes"""
+    return Path(meta_file).with_name(unescape_filename(info.get("filnamn", "")))
+
+
+REVISION_PATTERN = re.compile(r"_\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}$")
+
+
+def sidecar_files(image) -> list[Path]:
+    """The metadata file of an image followed by its old revisions, those that exist"""
+    current = sidecar_path(image)
+    revisions = [
+        revision
+        for revision in current.parent.glob(glob.escape(current.stem) + "_*.yaml")
+        if REVISION_PATTERN.fullmatch(revision.stem[len(current.stem) :])
+    ]
+    return [path for path in [current] if path.exists()] + sorted(revisions)
+
+
+def move_sidecars(image, new_image) -> list[Path]:
+    """Move the metadata files of an image that was moved or renamed to new_image.
+
+    The filnamn in every file is updated. Nothing is overwritten, returns the new paths.
+    """
+    image = Path(image)
+    new_image = Path(new_image)
+    old_stem = sidecar_path(image).stem
+    new_stem = sidecar_path(new_image).stem
+    moved = []
+    for meta_file in sidecar_files(image):
+        target = new_image.parent / (new_stem + meta_file.name[len(old_stem) :])
+        if target.exists():
+            print(f"{target} already exists, not moving {meta_file}")
+            continue
+        text = meta_file.read_text(encoding="utf-8")
+        text = re.sub(
+            r"^filnamn: .*$",
+            lambda match: f"filnamn: {escape_filename(new_image.name)}",
+            text,
+            count=1,
+            flags=re.MULTILINE,
+        )
+        tmp_file = target.with_suffix(".yaml.tmp")
+        tmp_file.write_text(text, encoding="utf-8")
+        os.replace(tmp_file, target)
+        meta_file.unlink()
+        moved.append(target)
+    return moved
+
+
+def iter_sidecars(directory, recursive: bool = True):
+    directory = Path(directory)
+    pattern = "**/*_metadata.yaml" if recursive else "*_metadata.yaml"
+    for meta_file in directory.glob(pattern):
+        if is_sidecar(meta_file):
+            yield meta_file
+
+
+def load_info(meta_file) -> dict:
+    """Read back a metadata file written by save_info.
+
+    Only understands the exact layout save_info writes, so no YAML library is needed.
+    People are returned under "personer" with the same shape as PhotoMetaApp.people.
+    """
+    info = {}
+    people = []
+    current = info
+    indent = 0
+    block_key = None
+    block_lines = []
+
+    def end_block():
+        nonlocal block_key
+        if block_key is not None:
+            current[block_key] = "\n".join(block_lines)
+            block_key = None
+            block_lines.clear()
+
+    for line in Path(meta_file).read_text(encoding="utf-8").splitlines():
+        if block_key is not None:
+            if line.startswith(" " * (indent + 2)):
+                block_lines.append(line[indent + 2 :])
+                continue
+            end_block()
+
+        stripped = line.lstrip(" ")
+        if not stripped or stripped.startswith("#"):
+            continue
+        indent = len(line) - len(stripped)
+
+        if stripped.startswith("- "):
+            current = {"coordinates": (None, None), "metadata": []}
+            people.append(current)
+            continue
+        if indent == 0:
+            current = info
+
+        key, _, value = stripped.partition(":")
+        value = value.strip()
+        if key in ("vänster", "upp") and current is not info:
+            coordinate = float(value.rstrip("%")) / 100
+            x, y = current["coordinates"]
+            current["coordinates"] = (
+                (coordinate, y) if key == "vänster" else (x, coordinate)
+            )
+        elif key in ("koordinater", "personer"):
+            continue
+        elif value == "|":
+            block_key = key
+        else:
+            current[key] = value
+    end_block()
+
+    for person in people:
+        fields = {
+            key: person.pop(key)
+            for key in list(person)
+            if key not in ("coordinates", "metadata")
+        }
+        person["metadata"] = [(key, value) for key, value in fields.items() if value]
+    info["personer"] = people
+    return info
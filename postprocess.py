@@ -0,0 +1,289 @@
+"""Optional archival processing of new scans, before they are shown for annotation.
+
+Raw scans are recompressed without losing any information (optimized PNG, deflate
+compressed TIFF and Huffman optimized JPEG), optionally turned the right way up from
+the EXIF orientation, and their BLAKE2b hash is appended to a kontrollsummor.blake2b
+manifest in the same folder, in the format `b2sum -c` reads.
+
+A scan is only touched once its size and modification time stopped changing, and it is
+only replaced if the new file decodes to the same pixels. Images with more than 8 bits
+per channel are left as they are, since Pillow would save them with 8.
+
+PNG and TIFF need Pillow and JPEG needs jpegtran, files are left as they are when these
+are not installed. Turned on with `postprocess = true` in the config, with
+`postprocess_workers` (default 2) and `postprocess_autorotate` (default true).
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+from pathlib import Path
+import shutil
+import struct
+import subprocess
+import threading
+import time
+
+from metadata import file_digest
+from util import get_config
+
+MANIFEST_NAME = "kontrollsummor.blake2b"
+
+EXIF_ORIENTATION = 0x0112
+TIFF_BITS_PER_SAMPLE = 258
+
+# Pillow modes that are written back with the same number of bits, 16 bit colour is
+# opened as 8 bit RGB so the bit depth is also checked before the mode
+ROUND_TRIP_MODES = {"1", "L", "LA", "P", "PA", "RGB", "RGBA", "CMYK"}
+
+# seconds the size and modification time of a scan must stay the same before it is rewritten
+STABLE_INTERVAL = 1.0
+STABLE_TIMEOUT = 300
+
+# EXIF orientation -> jpegtran arguments that turn the image the right way up
+JPEGTRAN_TRANSFORMS = {
+    2: ["-flip", "horizontal"],
+    3: ["-rotate", "180"],
+    4: ["-flip", "vertical"],
+    5: ["-transpose"],
+    6: ["-rotate", "90"],
+    7: ["-transverse"],
+    8: ["-rotate", "270"],
+}
+
+
+def _temporary_path(image: Path) -> Path:
+    # a suffix that is not an image, so the watcher does not see it as a new scan
+    return image.with_name(f".{image.name}.tmp")
+
+
+def _wait_until_written(image: Path) -> bool:
+    """True once the size and modification time of image stopped changing"""
+    deadline = time.monotonic() + STABLE_TIMEOUT
+    previous = None
+    while time.monotonic() < deadline:
+        stat = image.stat()
+        current = (stat.st_size, stat.st_mtime_ns)
+        if current == previous:
+            return True
+        previous = current
+        time.sleep(STABLE_INTERVAL)
+    return False
+
+
+def _png_bit_depth(image: Path) -> int:
+    with open(image, "rb") as file:
+        header = file.read(25)
+    # signature, IHDR length and type, width and height come before the bit depth
+    return header[24] if len(header) == 25 and header[12:16] == b"IHDR" else 0
+
+
+def _same_image(
+    image: Path, tmp_path: Path, rotated: bool, pixels: bool = True
+) -> bool:
+    """Whether tmp_path decodes to the same frames, mode, size and pixels as image"""
+    try:
+        from PIL import Image, ImageOps, ImageSequence
+    except ImportError:
+        # jpegtran output can not be checked without Pillow, it is lossless by itself
+        return True
+
+    with Image.open(image) as source, Image.open(tmp_path) as result:
+        if getattr(source, "n_frames", 1) != getattr(result, "n_frames", 1):
+            return False
+        frames = zip(ImageSequence.Iterator(source), ImageSequence.Iterator(result))
+        for source_frame, result_frame in frames:
+            expected = (
+                ImageOps.exif_transpose(source_frame) if rotated else source_frame
+            )
+            if expected.mode != result_frame.mode or expected.size != result_frame.size:
+                return False
+            if pixels and expected.tobytes() != result_frame.tobytes():
+                return False
+    return True
+
+
+def _jpeg_orientation_offset(data: bytes) -> tuple[int, str] | None:
+    """Position and byte order of the EXIF orientation value in a JPEG file"""
+    position = 2
+    while position + 4 <= len(data) and data[position] == 0xFF:
+        marker = data[position + 1]
+        (length,) = struct.unpack(">H", data[position + 2 : position + 4])
+        segment = position + 4
+        if marker == 0xE1 and data[segment : segment + 6] == b"Exif\0\0":
+            tiff = segment + 6
+            endian = "<" if data[tiff : tiff + 2] == b"II" else ">"
+            (ifd,) = struct.unpack(endian + "I", data[tiff + 4 : tiff + 8])
+            (entries,) = struct.unpack(endian + "H", data[tiff + ifd : tiff + ifd + 2])
+            for i in range(entries):
+                entry = tiff + ifd + 2 + i * 12
+                (tag,) = struct.unpack(endian + "H", data[entry : entry + 2])
+                if tag == EXIF_ORIENTATION:
+                    return entry + 8, endian
+            return None
+        if marker == 0xDA:
+            return None
+        position = segment + length - 2
+    return None
+
+
+def _process_jpeg(image: Path, tmp_path: Path, autorotate: bool) -> bool:
+    jpegtran = shutil.which("jpegtran")
+    if not jpegtran:
+        return False
+    data = image.read_bytes()
+    orientation_offset = _jpeg_orientation_offset(data)
+    transform = []
+    if autorotate and orientation_offset:
+        offset, endian = orientation_offset
+        (orientation,) = struct.unpack(endian + "H", data[offset : offset + 2])
+        transform = JPEGTRAN_TRANSFORMS.get(orientation, [])
+    command = [jpegtran, "-copy", "all", "-optimize"]
+    if transform:
+        # -perfect refuses transforms that would have to drop edge pixels
+        command += ["-perfect"] + transform
+    result = subprocess.run(
+        command + ["-outfile", str(tmp_path), str(image)], capture_output=True
+    )
+    if result.returncode != 0:
+        tmp_path.unlink(missing_ok=True)
+        return False
+    if transform:
+        # the pixels are turned now, so the orientation must say so
+        output = bytearray(tmp_path.read_bytes())
+        offset, endian = _jpeg_orientation_offset(output)
+        output[offset : offset + 2] = struct.pack(endian + "H", 1)
+        tmp_path.write_bytes(output)
+    return bool(transform)
+
+
+def _process_with_pillow(image: Path, tmp_path: Path, autorotate: bool) -> bool:
+    try:
+        from PIL import Image, ImageOps, PngImagePlugin
+    except ImportError:
+        return False
+
+    with Image.open(image) as picture:
+        picture_format = picture.format
+        # 16 bit scans would be saved back with 8 bits per channel
+        if picture.mode not in ROUND_TRIP_MODES:
+            return False
+        if picture_format == "PNG" and _png_bit_depth(image) > 8:
+            return False
+        if picture_format == "TIFF":
+            bits = picture.tag_v2.get(TIFF_BITS_PER_SAMPLE, (8,))
+            if max(bits if isinstance(bits, tuple) else (bits,)) > 8:
+                return False
+        exif = picture.getexif()
+        pages = getattr(picture, "n_frames", 1)
+        rotate = autorotate and pages == 1 and exif.get(EXIF_ORIENTATION, 1) != 1
+        if rotate:
+            output = ImageOps.exif_transpose(picture)
+            exif = output.getexif()
+        else:
+            output = picture
+        options = {"exif": exif.tobytes()} if exif else {}
+        if picture.info.get("dpi"):
+            options["dpi"] = picture.info["dpi"]
+        if picture.info.get("icc_profile"):
+            options["icc_profile"] = picture.info["icc_profile"]
+        if picture_format == "PNG":
+            text = getattr(picture, "text", {})
+            if text:
+                options["pnginfo"] = PngImagePlugin.PngInfo()
+                for key, value in text.items():
+                    options["pnginfo"].add_text(key, value)
+            output.save(tmp_path, "PNG", optimize=True, **options)
+        elif picture_format == "TIFF":
+            output.save(
+                tmp_path,
+                "TIFF",
+                compression="tiff_adobe_deflate",
+                save_all=pages > 1,
+                **options,
+            )
+        else:
+            return False
+    return rotate
+
+
+def process_image(path, autorotate: bool = True) -> dict:
+    """Recompress one image in place, run in a worker process.
+
+    The file is only replaced if it was turned or got smaller, and the new file decodes
+    to the same pixels as the old one.
+    """
+    image = Path(path)
+    if not _wait_until_written(image):
+        raise OSError(f"{image} is still being written")
+    tmp_path = _temporary_path(image)
+    suffix = image.suffix.lower()
+    original_size = image.stat().st_size
+    rotated = False
+    pixels = True
+    try:
+        if suffix in [".jpg", ".jpeg"]:
+            rotated = _process_jpeg(image, tmp_path, autorotate)
+            # turned JPEG files are decoded with other chroma upsampling, so only the
+            # mode and size can be compared then
+            pixels = not rotated
+        elif suffix in [".png", ".tif", ".tiff"]:
+            rotated = _process_with_pillow(image, tmp_path, autorotate)
+        if (
+            tmp_path.exists()
+            and (rotated or tmp_path.stat().st_size < original_size)
+            and _same_image(image, tmp_path, rotated, pixels)
+        ):
+            os.replace(tmp_path, image)
+        else:
+            rotated = False
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return {
+        "image": str(image),
+        "digest": file_digest(image),
+        "saved_bytes": original_size - image.stat().st_size,
+        "rotated": rotated,
+    }
+
+
+class PostProcessor:
+    """Runs process_image for new scans in a process pool and writes the checksum manifest"""
+
+    def __init__(self, workers: int = 2, autorotate: bool = True):
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.autorotate = autorotate
+        self.manifest_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls):
+        """A PostProcessor if it is turned on in the config, otherwise None"""
+        config = get_config()
+        if not config.getboolean("General", "postprocess", fallback=False):
+            return None
+        return cls(
+            config.getint("General", "postprocess_workers", fallback=2),
+            config.getboolean("General", "postprocess_autorotate", fallback=True),
+        )
+
+    def submit(self, image: Path, on_done):
+        """Process image and then call on_done(image) from a background thread, also if processing failed"""
+        future = self.executor.submit(process_image, str(image), self.autorotate)
+
+        def finished(future):
+            try:
+                result = future.result()
+            except Exception as error:
+                print(f"Could not process {image}: {error}")
+            else:
+                self.add_to_manifest(Path(result["image"]), result["digest"])
+            on_done(image)
+
+        future.add_done_callback(finished)
+
+    def add_to_manifest(self, image: Path, digest: str):
+        with self.manifest_lock:
+            with open(image.parent / MANIFEST_NAME, "a", encoding="utf-8") as manifest:
+                manifest.write(f"{digest}  {image.name}\n")
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,131 @@
+"""Find images again for metadata files that lost them, after images were renamed or moved while the program was not running.
+
+Only images without metadata of the same size as the lost image are hashed, and hashes
+are cached between runs by path, size and modification time, so a large archive does
+not compare every file against every other.
+
+    python reconcile.py <archive folder>          # show what would be moved
+    python reconcile.py <archive folder> --apply  # move the metadata files
+"""
+
+import argparse
+import json
+from pathlib import Path
+
+from metadata import (
+    file_digest,
+    iter_sidecars,
+    load_info,
+    move_sidecars,
+    sidecar_image,
+    sidecar_path,
+)
+from scanning import IMAGE_EXTENSIONS
+from util import app_data_path
+
+
+CACHE_PATH = app_data_path("slaktskanning_hashes.json")
+
+
+class HashCache:
+    """File hashes keyed by path, reused while the size and modification time are the same"""
+
+    def __init__(self, path: Path = CACHE_PATH):
+        self.path = Path(path)
+        try:
+            self.entries = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def digest(self, image: Path) -> str:
+        stat = image.stat()
+        key = str(image.absolute())
+        entry = self.entries.get(key)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        digest = file_digest(image)
+        self.entries[key] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def save(self):
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self.entries), encoding="utf-8")
+        tmp_path.replace(self.path)
+
+
+def find_matches(archive: Path, cache: HashCache, trust_size: bool = False):
+    """Yield (lost image, found image or None) for every metadata file without its image"""
+    lost = []
+    for meta_file in iter_sidecars(archive):
+        try:
+            info = load_info(meta_file)
+        except (OSError, ValueError):
+            continue
+        image = sidecar_image(meta_file, info)
+        if not image.exists():
+            lost.append((image, info))
+    if not lost:
+        return
+
+    # images without metadata, grouped by size so only files that can match are hashed
+    by_size: dict[int, list[Path]] = {}
+    for image in archive.glob("**/*"):
+        if (
+            image.suffix.lower() in IMAGE_EXTENSIONS
+            and image.is_file()
+            and not sidecar_path(image).exists()
+        ):
+            by_size.setdefault(image.stat().st_size, []).append(image)
+
+    for image, info in lost:
+        try:
+            size = int(info.get("bildfilen_storlek_byte", ""))
+        except ValueError:
+            yield image, None
+            continue
+        candidates = by_size.get(size, [])
+        expected = info.get("bildfilen_blake2b")
+        if expected:
+            found = next(
+                (
+                    candidate
+                    for candidate in candidates
+                    if cache.digest(candidate) == expected
+                ),
+                None,
+            )
+        else:
+            # metadata from before hashes were saved, the size is all there is
+            found = candidates[0] if trust_size and len(candidates) == 1 else None
+        if found:
+            candidates.remove(found)
+        yield image, found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("archive", type=Path)
+    parser.add_argument("--apply", action="store_true", help="move the metadata files")
+    parser.add_argument(
+        "--trust-size",
+        action="store_true",
+        help="match metadata without a hash to the only image of the same size",
+    )
+    args = parser.parse_args()
+
+    cache = HashCache()
+    try:
+        for image, found in find_matches(args.archive, cache, args.trust_size):
+            if found is None:
+                print(f"No image found for {sidecar_path(image)}")
+            elif args.apply:
+                move_sidecars(image, found)
+                print(f"Moved metadata of {image.name} to {found}")
+            else:
+                print(f"Would move metadata of {image.name} to {found}")
+    finally:
+        cache.save()
+
+
+if __name__ == "__main__":
+    main()
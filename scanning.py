@@ -0,0 +1,408 @@
+from collections import deque
+import json
+from pathlib import Path
+import threading
+import time
+
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+
+from metadata import file_digest, load_info, move_sidecars, sidecar_path
+from postprocess import _temporary_path
+from util import get_config, save_config
+
+IMAGE_EXTENSIONS = [".jpg", ".jpeg", ".png", ".gif", ".tif", ".tiff", ".bmp", ".webp"]
+
+
+class WatchRoot:
+    """A folder to watch for new scans, with its own recursion and file extensions"""
+
+    def __init__(
+        self, path, recursive: bool = False, extensions: list[str] | None = None
+    ):
+        self.path = Path(path).expanduser()
+        self.recursive = recursive
+        self.extensions = [
+            extension.lower() for extension in (extensions or IMAGE_EXTENSIONS)
+        ]
+        self.stats = {
+            "found": 0,
+            "queued": 0,
+            "duplicates": 0,
+            "ignored": 0,
+            "moved": 0,
+        }
+
+    def matches(self, path) -> bool:
+        return Path(path).suffix.lower() in self.extensions
+
+    def to_dict(self) -> dict:
+        return {
+            "path": str(self.path),
+            "recursive": self.recursive,
+            "extensions": self.extensions,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(data["path"], data.get("recursive", False), data.get("extensions"))
+
+
+def load_watch_roots() -> list[WatchRoot]:
+    """Watched folders from the config, falling back to the single scan_directory of older versions"""
+    config = get_config()
+    watch_roots = config.get("General", "watch_roots", fallback=None)
+    if watch_roots:
+        return [WatchRoot.from_dict(root) for root in json.loads(watch_roots)]
+    directory = config.get("General", "scan_directory", fallback=None)
+    return [WatchRoot(directory)] if directory else []
+
+
+def save_watch_roots(roots: list[WatchRoot]):
+    save_config(
+        {
+            "watch_roots": json.dumps(
+                [root.to_dict() for root in roots], ensure_ascii=False
+            ),
+            # kept for older versions of the program
+            "scan_directory": str(roots[0].path) if roots else "",
+        }
+    )
+
+
+class ScanQueue:
+    """Thread safe queue of images waiting for metadata, where every image is only queued once"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = deque()
+        # images handed out by get and not yet done
+        self.active = set()
+        # image being annotated -> (size, Future of its file_digest), so the image can be
+        # recognised when it is moved to another drive
+        self.fingerprints = {}
+
+    @staticmethod
+    def _key(path) -> Path:
+        return Path(path).resolve()
+
+    def put(self, path, first: bool = False) -> bool:
+        key = self._key(path)
+        with self.lock:
+            if key in self.active or key in self.pending:
+                return False
+            if first:
+                self.pending.appendleft(key)
+            else:
+                self.pending.append(key)
+            return True
+
+    def get(self) -> Path | None:
+        """Next image to annotate, it counts as queued until done is called"""
+        with self.lock:
+            if not self.pending:
+                return None
+            image = self.pending.popleft()
+            self.active.add(image)
+            return image
+
+    def done(self, path):
+        with self.lock:
+            self.active.discard(self._key(path))
+            self.fingerprints.pop(self._key(path), None)
+
+    def set_fingerprint(self, path, digest):
+        """Remember the size and the file_digest Future of an image that is being annotated"""
+        key = self._key(path)
+        try:
+            size = str(key.stat().st_size)
+        except OSError:
+            return
+        with self.lock:
+            self.fingerprints[key] = (size, digest)
+
+    def fingerprint(self, path) -> tuple | None:
+        with self.lock:
+            return self.fingerprints.get(self._key(path))
+
+    def requeue(self, path):
+        """Put an image that was handed out but not finished back first in the queue"""
+        self.done(path)
+        self.put(path, first=True)
+
+    def rename(self, path, new_path) -> str | None:
+        """Follow an image that was moved, keeping its place. Returns "pending", "active" or None.
+
+        An image opened by hand counts as active once it has a fingerprint.
+        """
+        key = self._key(path)
+        new_key = self._key(new_path)
+        with self.lock:
+            if key in self.pending:
+                self.pending[self.pending.index(key)] = new_key
+                return "pending"
+            if key in self.active or key in self.fingerprints:
+                if key in self.active:
+                    self.active.discard(key)
+                    self.active.add(new_key)
+                if key in self.fingerprints:
+                    self.fingerprints[new_key] = self.fingerprints.pop(key)
+                return "active"
+            return None
+
+    def discard(self, path) -> bool:
+        key = self._key(path)
+        with self.lock:
+            if key in self.pending:
+                self.pending.remove(key)
+                return True
+            return False
+
+    def __len__(self):
+        with self.lock:
+            return len(self.pending)
+
+
+class FileHandler(FileSystemEventHandler):
+    def __init__(self, watcher, root: WatchRoot):
+        self.watcher = watcher
+        self.root = root
+
+    def on_created(self, event):
+        if event.is_directory:
+            return
+        # Wait for file to be written
+        time.sleep(0.5)
+        self.watcher.new_scan(self.root, Path(event.src_path))
+
+    def on_moved(self, event):
+        if event.is_directory:
+            return
+        self.watcher.image_moved(self.root, Path(event.src_path), Path(event.dest_path))
+
+    def on_deleted(self, event):
+        if event.is_directory:
+            return
+        self.watcher.image_deleted(self.root, Path(event.src_path))
+
+
+class ScanWatcher:
+    """Watches all roots with one observer and feeds new images into one queue.
+
+    Metadata files follow their images when they are moved or renamed.
+    on_scan is called from the observer thread every time an image was added to the queue,
+    on_sidecar_moved with the old and new path of a moved metadata file and on_image_moved
+    with the old and new path of an image that is being annotated.
+    """
+
+    # seconds a deleted image with metadata or being annotated is remembered, in case it
+    # shows up somewhere else
+    reattach_timeout = 120
+
+    def __init__(
+        self,
+        on_scan=None,
+        on_sidecar_moved=None,
+        postprocessor=None,
+        on_image_moved=None,
+    ):
+        self.on_scan = on_scan
+        self.on_sidecar_moved = on_sidecar_moved
+        self.on_image_moved = on_image_moved
+        self.roots: list[WatchRoot] = []
+        self.queue = ScanQueue()
+        self.observer = None
+        # (time, image, size, hash) of deleted images that had metadata or were being annotated
+        self.deleted = deque()
+        # (time, image) of new images, a move between drives may create the copy before
+        # the original is deleted
+        self.created = deque()
+        # new images that turned out to be moved, so they are not queued after processing
+        self.attached = set()
+        # optional PostProcessor that new scans go through before they are queued
+        self.postprocessor = postprocessor
+        self.processing = set()
+
+    def set_roots(self, roots: list[WatchRoot]):
+        self.stop()
+        self.roots = list(roots)
+        self.observer = Observer()
+        for root in self.roots:
+            self.observer.schedule(
+                FileHandler(self, root), path=str(root.path), recursive=root.recursive
+            )
+        self.observer.start()
+
+    def stop(self):
+        if self.observer:
+            self.observer.stop()
+            self.observer.join()
+            self.observer = None
+
+    def shutdown(self):
+        """Stop watching and processing for good"""
+        self.stop()
+        if self.postprocessor:
+            self.postprocessor.shutdown()
+
+    def new_scan(self, root: WatchRoot, image: Path):
+        if not root.matches(image):
+            root.stats["ignored"] += 1
+            return
+        if self.deleted and self.reattach(image):
+            root.stats["moved"] += 1
+            return
+        self.created.append((time.monotonic(), image))
+        root.stats["found"] += 1
+        if self.postprocessor:
+            key = image.resolve()
+            with self.queue.lock:
+                # never touch an image that is being annotated or already processed
+                busy = (
+                    key in self.queue.active
+                    or key in self.queue.pending
+                    or key in self.processing
+                )
+                if not busy:
+                    self.processing.add(key)
+            if busy:
+                root.stats["duplicates"] += 1
+            else:
+                self.postprocessor.submit(
+                    image, lambda image: self.processed(root, image, key)
+                )
+            return
+        self.enqueue(root, image)
+
+    def processed(self, root: WatchRoot, image: Path, key: Path):
+        with self.queue.lock:
+            self.processing.discard(key)
+        self.enqueue(root, image)
+
+    def enqueue(self, root: WatchRoot, image: Path):
+        with self.queue.lock:
+            attached = image.resolve() in self.attached
+            self.attached.discard(image.resolve())
+        if attached:
+            # the metadata of a moved image was attached to it while it was processed
+            root.stats["moved"] += 1
+            return
+        if self.queue.put(image):
+            root.stats["queued"] += 1
+            if self.on_scan:
+                self.on_scan()
+        else:
+            root.stats["duplicates"] += 1
+
+    def move_metadata(self, image: Path, new_image: Path):
+        moved = move_sidecars(image, new_image)
+        new_meta_file = sidecar_path(new_image)
+        if new_meta_file in moved and self.on_sidecar_moved:
+            self.on_sidecar_moved(sidecar_path(image), new_meta_file)
+
+    def image_moved(self, root: WatchRoot, image: Path, new_image: Path):
+        if image == _temporary_path(new_image):
+            # post-processing replaced the scan with its recompressed copy
+            return
+        if not root.matches(image):
+            # e.g. an upload that is renamed from a temporary name when it is done
+            self.new_scan(root, new_image)
+            return
+        if not root.matches(new_image):
+            return
+        self.follow(image, new_image)
+        root.stats["moved"] += 1
+
+    def follow(self, image: Path, new_image: Path):
+        """Move the metadata and the place in the queue of an image to where it was moved"""
+        state = self.queue.rename(image, new_image)
+        self.move_metadata(image, new_image)
+        if state == "active" and self.on_image_moved:
+            self.on_image_moved(image, new_image)
+
+    def image_deleted(self, root: WatchRoot, image: Path):
+        if not root.matches(image):
+            return
+        self.queue.discard(image)
+        fingerprint = self.queue.fingerprint(image)
+        if fingerprint:
+            # the image being annotated, which may not have any metadata file yet
+            size, digest = fingerprint
+            try:
+                digest = digest.result()
+            except OSError:
+                digest = None
+            entry = (time.monotonic(), image, size, digest)
+        else:
+            meta_file = sidecar_path(image)
+            try:
+                info = load_info(meta_file)
+            except (OSError, ValueError):
+                return
+            entry = (
+                time.monotonic(),
+                image,
+                info.get("bildfilen_storlek_byte"),
+                info.get("bildfilen_blake2b"),
+            )
+        if not self.attach_to_created(entry):
+            self.deleted.append(entry)
+
+    def _matches(self, entry, image: Path) -> bool:
+        """Whether image is the same file as the deleted image of entry"""
+        _, old_image, old_size, digest = entry
+        return (
+            old_size == str(image.stat().st_size)
+            and bool(digest)
+            and not old_image.exists()
+            and not sidecar_path(image).exists()
+            and file_digest(image) == digest
+        )
+
+    def attach_to_created(self, entry) -> bool:
+        """Move the metadata of a deleted image to an image created just before it.
+
+        Moves between drives copy the image first and delete the original afterwards.
+        """
+        now = time.monotonic()
+        while self.created and now - self.created[0][0] > self.reattach_timeout:
+            self.created.popleft()
+        for created in list(self.created):
+            image = created[1]
+            try:
+                if not self._matches(entry, image):
+                    continue
+            except OSError:
+                continue
+            self.created.remove(created)
+            with self.queue.lock:
+                if image.resolve() in self.processing:
+                    self.attached.add(image.resolve())
+            self.queue.discard(image)
+            self.follow(entry[1], image)
+            return True
+        return False
+
+    def reattach(self, image: Path) -> bool:
+        """Move the metadata of a recently deleted image to image, if it is the same file.
+
+        Moves between folders or drives are seen as a delete followed by a new file.
+        """
+        now = time.monotonic()
+        while self.deleted and now - self.deleted[0][0] > self.reattach_timeout:
+            self.deleted.popleft()
+        try:
+            for entry in list(self.deleted):
+                if self._matches(entry, image):
+                    self.deleted.remove(entry)
+                    self.follow(entry[1], image)
+                    return True
+        except OSError:
+            pass
+        return False
+
+    def status_text(self) -> str:
+        return "\n".join(
+            f"{root.path} ({root.stats['queued']} nya, {root.stats['duplicates']} dubbletter)"
+            for root in self.roots
+        )
@@ -0,0 +1,208 @@
+"""Soak test of the annotation window, to find memory and widget leaks.
+
+Runs thousands of scan, tag and submit cycles offscreen, with the menus and dialogs
+answered automatically, and reports the memory use, the number of QObjects below
+the long lived widgets and how long the person dialog takes to open. Config and
+metadata files go to a temporary folder.
+
+    python soak.py --cycles 2000
+
+Exits with status 1 if the number of QObjects keeps growing, going by the trend over all
+samples.
+"""
+
+import argparse
+import json
+import os
+from pathlib import Path
+import random
+import sys
+import tempfile
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+# keep the config, journal and indexes away from the real ones, before importing the program
+TEMP_HOME = Path(tempfile.mkdtemp(prefix="slaktskanning_soak_"))
+os.environ["HOME"] = os.environ["APPDATA"] = str(TEMP_HOME)
+
+from PySide2.QtCore import QEvent, QObject, QPoint, Qt, QTimer
+from PySide2.QtGui import QImage, QKeyEvent, QMouseEvent
+from PySide2.QtWidgets import QApplication, QDialog, QMenu
+
+from PersonSearchDialog import PersonSearchDialog
+from util import save_config
+from window import PhotoMetaApp
+
+NAMES = [("Nina", "Eriksson"), ("Thomas", "Gustafsson"), ("Sven", "Andersson")]
+
+
+def rss_bytes() -> int | None:
+    """Resident memory of this process"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        pass
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return None
+
+
+class Autopilot:
+    """Answers the modal menus and dialogs that would otherwise wait for a user"""
+
+    def __init__(self):
+        self.menu_choice = "Tagga person"
+
+    def answer_menu(self):
+        """Pick menu_choice in the open popup menu like a user would, with Enter"""
+        menu = QApplication.activePopupWidget()
+        if not isinstance(menu, QMenu):
+            QTimer.singleShot(1, self.answer_menu)
+            return
+        action = next(
+            (action for action in menu.actions() if action.text() == self.menu_choice),
+            None,
+        )
+        if action is None:
+            menu.close()
+            return
+        menu.setActiveAction(action)
+        QApplication.sendEvent(
+            menu, QKeyEvent(QEvent.KeyPress, Qt.Key_Return, Qt.NoModifier)
+        )
+
+    def dialog_exec(self, dialog):
+        # shown like exec_ would, which also records the person dialog latency
+        dialog.show()
+        QApplication.processEvents()
+        if isinstance(dialog, PersonSearchDialog):
+            dialog.search_box.setText(random.choice(NAMES)[0])
+        else:
+            first_name, last_name = random.choice(NAMES)
+            dialog.fields["förnamn"].setText(first_name)
+            dialog.fields["efternamn"].setText(last_name)
+        dialog.accept()
+        return dialog.result()
+
+    def install(self):
+        # a plain function, so the dialog is passed in like to the real exec_. QMenu.exec_
+        # is overloaded and can not be replaced like this, menus are answered by a timer
+        QDialog.exec_ = lambda dialog, *args: self.dialog_exec(dialog)
+
+    def click(self, label, x: float, y: float):
+        QTimer.singleShot(0, self.answer_menu)
+        click(label, x, y)
+
+
+def click(label, x: float, y: float):
+    position = QPoint(int(x * label.width()), int(y * label.height()))
+    event = QMouseEvent(
+        QEvent.MouseButtonPress, position, Qt.LeftButton, Qt.LeftButton, Qt.NoModifier
+    )
+    label.mousePressEvent(event)
+
+
+def count_objects(widget) -> int:
+    return len(widget.findChildren(QObject))
+
+
+def slope(samples: list[tuple], column: int) -> float:
+    """Least squares growth of a column per cycle, over all samples"""
+    points = [(sample[0], sample[column]) for sample in samples]
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    spread = sum((x - mean_x) ** 2 for x, _ in points)
+    if not spread:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / spread
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cycles", type=int, default=2000)
+    parser.add_argument("--people", type=int, default=5, help="people per image")
+    parser.add_argument("--report-every", type=int, default=200)
+    args = parser.parse_args()
+
+    # scans are queued directly, the watched folder stays empty so they are not queued twice
+    scan_folder = TEMP_HOME / "scans"
+    scan_folder.mkdir()
+    watched_folder = TEMP_HOME / "watched"
+    watched_folder.mkdir()
+    save_config(
+        {"watch_roots": json.dumps([{"path": str(watched_folder), "recursive": False}])}
+    )
+
+    app = QApplication(sys.argv)
+    autopilot = Autopilot()
+    autopilot.install()
+    window = PhotoMetaApp()
+
+    template = QImage(64, 48, QImage.Format_RGB32)
+    template.fill(Qt.gray)
+
+    print(f"{'cycle':>8} {'rss MiB':>10} {'window objects':>15} {'label objects':>14}")
+    samples = []
+    for cycle in range(1, args.cycles + 1):
+        image = scan_folder / f"scan_{cycle:06}.png"
+        template.save(str(image))
+        window.watcher.queue.put(image)
+        window.show_next_scan()
+
+        for _ in range(args.people):
+            autopilot.menu_choice = random.choice(
+                [
+                    "Tagga person",
+                    "Tagga person",
+                    "Okänd person",
+                    "Tidigare ifylld person",
+                ]
+            )
+            autopilot.click(window.image_label, random.random(), random.random())
+        window.fields["plats"].setText(f"Plats {cycle % 50}")
+        window.submit()
+
+        app.processEvents()
+        app.sendPostedEvents(None, QEvent.DeferredDelete)
+
+        if cycle % args.report_every == 0 or cycle == args.cycles:
+            rss = rss_bytes()
+            sample = (
+                cycle,
+                rss,
+                count_objects(window),
+                count_objects(window.image_label),
+            )
+            samples.append(sample)
+            rss_text = f"{rss / 2**20:.1f}" if rss else "?"
+            print(f"{cycle:>8} {rss_text:>10} {sample[2]:>15} {sample[3]:>14}")
+
+    latencies = sorted(window.image_label.person_dialog.open_latencies)
+    if latencies:
+        median = latencies[len(latencies) // 2]
+        print(
+            f"Person dialog shown {median * 1000:.2f} ms after it was asked for (median)"
+        )
+
+    window.quit_app()
+    if len(samples) < 3:
+        print(
+            "Too few samples for a trend, use more cycles or a smaller --report-every"
+        )
+        return
+    # the first sample is left out, caches and lazily built widgets are still warming up
+    trend = samples[1:]
+    objects_growth = max(slope(trend, 2), slope(trend, 3)) * 1000
+    print(f"QObjects per 1000 cycles: {objects_growth:+.1f}")
+    if all(sample[1] for sample in trend):
+        print(f"RSS per 1000 cycles: {slope(trend, 1) * 1000 / 2**20:+.2f} MiB")
+    if objects_growth >= 1:
+        print("QObjects keep growing, something is leaking")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,11 +13,16 @@ def resource_path(relative_path):
     return os.path.join(base_path, relative_path)
 
 
-CONFIG_PATH = (
-    Path(os.getenv("APPDATA")) / "slaktskanning.ini"
-    if os.name == "nt"
-    else Path.home() / ".slaktskanning.ini"
-)
+def app_data_path(filename: str) -> Path:
+    """Path for a file that persists between sessions, next to the config file"""
+    return (
+        Path(os.getenv("APPDATA")) / filename
+        if os.name == "nt"
+        else Path.home() / f".{filename}"
+    )
+
+
+CONFIG_PATH = app_data_path("slaktskanning.ini")
 
 
 def get_config():
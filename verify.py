@@ -0,0 +1,112 @@
+"""Check an archive of scanned images against their metadata files.
+
+Re-hashes every image that has a metadata file and compares it with the size and
+BLAKE2b hash saved by save_info. Reports:
+
+- mismatch: the image has changed or the metadata belongs to another file
+- missing image: the metadata file names an image that does not exist
+- orphan metadata: a metadata file that does not belong to any image
+- no hash: metadata written before hashes were saved, only the size was checked
+
+    python verify.py <archive folder> [--jobs 4] [--io 2]
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import os
+from pathlib import Path
+import sys
+
+from metadata import file_digest, is_sidecar, iter_sidecars, load_info, sidecar_image
+
+
+_io_slots = None
+
+
+def _init_worker(io_slots):
+    global _io_slots
+    _io_slots = io_slots
+
+
+def _hash_image(image: Path) -> str:
+    # limits how many images are read at the same time, independent of the number of processes
+    with _io_slots:
+        return file_digest(image)
+
+
+def find_problems(archive: Path, jobs: int, io: int):
+    """Yield (kind, path, detail) for every problem in the archive"""
+    to_hash = []
+    current_stems = set()
+    for meta_file in iter_sidecars(archive):
+        current_stems.add(meta_file.with_name(meta_file.stem))
+        try:
+            info = load_info(meta_file)
+        except (OSError, ValueError) as error:
+            yield "orphan metadata", meta_file, f"could not be read: {error}"
+            continue
+        image = sidecar_image(meta_file, info)
+        if not info.get("filnamn") or image.stem + "_metadata" != meta_file.stem:
+            yield "orphan metadata", meta_file, f"describes {info.get('filnamn')!r}"
+        elif not image.exists():
+            yield "missing image", image, f"named in {meta_file.name}"
+        elif str(image.stat().st_size) != info.get("bildfilen_storlek_byte"):
+            yield "mismatch", image, "size differs from the metadata"
+        elif not info.get("bildfilen_blake2b"):
+            yield "no hash", image, "size matches"
+        else:
+            to_hash.append((image, info["bildfilen_blake2b"]))
+
+    # revisions left by save_info whose current metadata file is gone
+    for revision in archive.glob("**/*_metadata_*.yaml"):
+        if is_sidecar(revision):
+            continue
+        current = revision.with_name(revision.stem.rsplit("_metadata_", 1)[0])
+        if current.with_name(current.name + "_metadata") not in current_stems:
+            yield "orphan metadata", revision, "old revision without metadata file"
+
+    io_slots = multiprocessing.BoundedSemaphore(io)
+    with ProcessPoolExecutor(
+        jobs, initializer=_init_worker, initargs=(io_slots,)
+    ) as pool:
+        futures = {
+            pool.submit(_hash_image, image): (image, expected)
+            for image, expected in to_hash
+        }
+        for future in as_completed(futures):
+            image, expected = futures[future]
+            try:
+                digest = future.result()
+            except OSError as error:
+                yield "missing image", image, str(error)
+                continue
+            if digest != expected:
+                yield "mismatch", image, "hash differs from the metadata"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("archive", type=Path)
+    parser.add_argument(
+        "--jobs", type=int, default=os.cpu_count(), help="processes hashing images"
+    )
+    parser.add_argument(
+        "--io", type=int, default=2, help="images read from disk at the same time"
+    )
+    args = parser.parse_args()
+
+    counts = {}
+    for kind, path, detail in find_problems(args.archive, args.jobs, args.io):
+        counts[kind] = counts.get(kind, 0) + 1
+        print(f"{kind}: {path} ({detail})")
+
+    if not counts:
+        print("No problems found")
+    else:
+        print(", ".join(f"{count} {kind}" for kind, count in counts.items()))
+    sys.exit(1 if set(counts) - {"no hash"} else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,24 @@
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import socket
 import sys
 from collections import OrderedDict
 from pathlib import Path
 import time
 
-from PySide2.QtCore import Signal, Qt
-from PySide2.QtGui import QIcon, QPixmap
+from PySide2.QtCore import QStringListModel, QTimer, Signal, Qt
+from PySide2.QtGui import QIcon, QImage, QPixmap
 from PySide2.QtWidgets import (
     QAction,
     QApplication,
+    QCompleter,
     QFileDialog,
     QHBoxLayout,
     QLabel,
     QLineEdit,
     QMainWindow,
     QMenu,
+    QMessageBox,
     QPushButton,
     QScrollArea,
     QSystemTrayIcon,
@@ -21,43 +26,107 @@ from PySide2.QtWidgets import (
     QVBoxLayout,
     QWidget,
 )
-from watchdog.events import FileSystemEventHandler
-from watchdog.observers import Observer
+from completion import CompletionEngine
+from cooccurrence import CooccurrenceIndex
+from daemon import DaemonClient, LeaseError
+from gedcom import FamilyTree
 from ImageLabel import ImageLabel, get_text_content
+from journal import AnnotationJournal
 from meta_schema import METADATA_SCHEMA
 
-from metadata import save_info
-from util import get_config, save_config, resource_path
+from metadata import file_digest, save_info
+from postprocess import PostProcessor
+from scanning import (
+    IMAGE_EXTENSIONS,
+    ScanWatcher,
+    WatchRoot,
+    load_watch_roots,
+    save_watch_roots,
+)
+from util import get_config, resource_path, save_config
 
 
 class PhotoMetaApp(QMainWindow):
     show_window_signal = Signal()
-
-    people: list[dict] = []
+    # old and new path of a metadata file that was moved with its image
+    sidecar_moved_signal = Signal(object, object)
+    # old and new path of the image being annotated, when it was moved or renamed
+    image_moved_signal = Signal(object, object)
+    # counts from FamilyTree.import_file, or None if the import failed
+    family_tree_imported_signal = Signal(object)
+    # callback, result and error of a daemon request made in the background
+    daemon_done_signal = Signal(object, object, object)
 
     def __init__(self):
         super().__init__()
 
-        self.observer = None
-        self.file_handler = FileHandler(self)
+        self.people: list[dict] = []
+
+        self.watcher = ScanWatcher(
+            on_scan=self.show_window_signal.emit,
+            on_sidecar_moved=self.sidecar_moved_signal.emit,
+            postprocessor=PostProcessor.from_config(),
+            on_image_moved=self.image_moved_signal.emit,
+        )
+        self.cooccurrence = CooccurrenceIndex.load()
+        self.completion = CompletionEngine()
+        self.family_tree = FamilyTree()
+        self.journal = AnnotationJournal()
+        # only edits made by the user after an image is shown are journaled
+        self.journaling = False
+        # the image is hashed in the background while it is being annotated
+        self.hash_executor = ThreadPoolExecutor(max_workers=1)
+        self.image_digest = None
+
+        config = get_config()
+        daemon_url = config.get("General", "daemon_url", fallback=None)
+        # annotate images handed out by a shared daemon.py instead of watching folders
+        self.daemon = (
+            DaemonClient(daemon_url, socket.gethostname()) if daemon_url else None
+        )
+        self.lease = None
+        # the image of the lease, downloaded together with it
+        self.lease_image = b""
+        # requests to the daemon are made one at a time outside of the GUI thread
+        self.daemon_executor = ThreadPoolExecutor(max_workers=1)
+        self.daemon_busy = False
+        self.daemon_failures = 0
+        self.daemon_retry_at = 0.0
 
         self.initUI()
         self.tray_icon = self.create_system_tray()
 
-        config = get_config()
-        directory = config.get("General", "scan_directory", fallback=None)
-        self.watched_directory = Path(directory).expanduser() if directory else None
-        if self.watched_directory and self.watched_directory.exists():
-            self.setup_file_observer()
-            self.tray_icon.setToolTip(f"Släktskanning\n{self.watched_directory}")
-            save_config({"scan_directory": str(self.watched_directory)})
+        # every configured folder, also the ones that are offline and not watched right now
+        self.watch_roots = load_watch_roots()
+        if self.daemon:
+            self.update_tray_tooltip()
+            self.daemon_timer = QTimer(self)
+            self.daemon_timer.timeout.connect(self.poll_daemon)
+            self.daemon_timer.start(5000)
+        elif self.watch_roots:
+            self.setup_file_observer(self.watch_roots, save=False)
         else:
             self.change_scan_folder()
-            if not self.watched_directory.exists():
+            if not self.watcher.roots:
                 self.quit_app()
+        self.index_watched_folders()
         self.selected_file = None
 
-        self.show_window_signal.connect(self.show_window)
+        self.show_window_signal.connect(self.show_next_scan)
+        self.sidecar_moved_signal.connect(self.cooccurrence.move_file)
+        self.image_moved_signal.connect(self.image_moved)
+        self.family_tree_imported_signal.connect(self.family_tree_imported)
+        self.daemon_done_signal.connect(self.daemon_done)
+
+        # the tree is read again if the GEDCOM file changed since the last import
+        gedcom_path = config.get("General", "gedcom_path", fallback=None)
+        if gedcom_path and Path(gedcom_path).exists():
+            self.family_tree.import_in_background(gedcom_path)
+
+        self.journal_timer = QTimer(self)
+        self.journal_timer.timeout.connect(self.journal.sync)
+        self.journal_timer.start(1000)
+        self.restore_session()
 
         font = self.font()
         font.setPointSize(12)
@@ -92,7 +161,16 @@ class PhotoMetaApp(QMainWindow):
         fields_layout = QVBoxLayout()
 
         # Image
-        self.image_label = ImageLabel(people=self.people)
+        self.image_label = ImageLabel(
+            people=self.people,
+            cooccurrence=self.cooccurrence,
+            family_tree=self.family_tree,
+            get_metadata=lambda: [
+                (key, get_text_content(value)) for key, value in self.fields.items()
+            ],
+        )
+        self.image_label.person_changed.connect(self.journal_person)
+        self.image_label.person_removed.connect(self.journal_person_removed)
         image_layout.addWidget(self.image_label)
         image_layout.addStretch(1)
         layout.addLayout(image_layout)
@@ -106,7 +184,12 @@ class PhotoMetaApp(QMainWindow):
             else:
                 field_input = QLineEdit()
             field_input.setPlaceholderText("  |  ".join(value["examples"]))
+            if key in self.completion.indexes:
+                self.add_completer(key, field_input)
             self.fields[key] = field_input
+            field_input.textChanged.connect(
+                lambda *args, key=key: self.journal_field(key)
+            )
             fields_layout.addWidget(field_input)
             if value.get("multiline"):
                 fields_layout.addStretch(1)
@@ -119,6 +202,47 @@ class PhotoMetaApp(QMainWindow):
 
         central_widget.setLayout(layout)
 
+    def add_completer(self, key, field_input):
+        model = QStringListModel(field_input)
+        completer = QCompleter(model, field_input)
+        completer.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
+        completer.setCaseSensitivity(Qt.CaseInsensitive)
+        field_input.setCompleter(completer)
+
+        def update_completions(text):
+            model.setStringList(self.completion.complete(key, text))
+            completer.complete()
+
+        field_input.textEdited.connect(update_completions)
+
+    def journal_field(self, key):
+        if self.journaling:
+            self.journal.set_field(key, get_text_content(self.fields[key]))
+
+    def journal_person(self, coordinates, metadata):
+        if self.journaling:
+            self.journal.set_person(coordinates, metadata)
+
+    def journal_person_removed(self, coordinates):
+        if self.journaling:
+            self.journal.remove_person(coordinates)
+
+    def restore_session(self):
+        """Reopen the image that was being annotated when the program stopped without Submit"""
+        session = AnnotationJournal.replay(self.journal.path)
+        if not session or self.daemon or not Path(session["image"]).exists():
+            return
+        self.selected_file = Path(session["image"])
+        self.show_window()
+        for key, text in session["fields"].items():
+            field = self.fields.get(key)
+            if isinstance(field, QTextEdit):
+                field.setPlainText(text)
+            elif field:
+                field.setText(text)
+        for person in session["people"]:
+            self.image_label.add_person(*person["coordinates"], person["metadata"])
+
     def create_system_tray(self):
         tray_icon = QSystemTrayIcon(QPixmap(resource_path("icon.png")))
         tray_menu = QMenu()
@@ -127,11 +251,17 @@ class PhotoMetaApp(QMainWindow):
         open_file_action.triggered.connect(self.open_single_file)
         choose_folder_action = QAction("Välj inskanningsmapp", self)
         choose_folder_action.triggered.connect(self.change_scan_folder)
+        add_folder_action = QAction("Lägg till inskanningsmapp", self)
+        add_folder_action.triggered.connect(self.add_scan_folder)
+        import_tree_action = QAction("Importera släktträd (GEDCOM)", self)
+        import_tree_action.triggered.connect(self.import_family_tree)
         exit_action = QAction("Avsluta", self)
         exit_action.triggered.connect(self.quit_app)
 
         tray_menu.addAction(open_file_action)
         tray_menu.addAction(choose_folder_action)
+        tray_menu.addAction(add_folder_action)
+        tray_menu.addAction(import_tree_action)
         tray_menu.addAction(exit_action)
         tray_icon.setContextMenu(tray_menu)
         tray_icon.activated.connect(self.tray_activated)
@@ -139,20 +269,33 @@ class PhotoMetaApp(QMainWindow):
         return tray_icon
 
     def show_window(self):
+        self.journaling = False
         time.sleep(0.1)
         # https://stackoverflow.com/a/56550014/10767416
         # bring window to top and act like a "normal" window!
-        self.setWindowFlags(
-            self.windowFlags() | Qt.WindowStaysOnTopHint
+        self.setWindowFlag(
+            Qt.WindowStaysOnTopHint, True
         )  # set always on top flag, makes window disappear
         self.show()  # makes window reappear, but it's ALWAYS on top
-        self.setWindowFlags(
-            self.windowFlags() & ~Qt.WindowStaysOnTopHint
+        self.setWindowFlag(
+            Qt.WindowStaysOnTopHint, False
         )  # clear always on top flag, makes window disappear
         self.show()  # makes window reappear, acts like normal window now (on top now but can be underneath if you raise another window)
 
-        if self.selected_file:
-            self.image_label.setPixmap(QPixmap(str(self.selected_file)))
+        if self.lease:
+            pixmap = QPixmap()
+            pixmap.loadFromData(self.lease_image)
+            self.image_label.setPixmap(pixmap)
+            self.setWindowTitle(f"Släktskanning - {self.selected_file.name}")
+        elif self.selected_file:
+            # not QPixmap(path), which keeps every scan ever shown in QPixmapCache
+            self.image_label.setPixmap(
+                QPixmap.fromImage(QImage(str(self.selected_file)))
+            )
+            self.image_digest = self.hash_executor.submit(
+                file_digest, self.selected_file
+            )
+            self.watcher.queue.set_fingerprint(self.selected_file, self.image_digest)
             self.setWindowTitle(f"Släktskanning - {self.selected_file.name}")
 
         for _, value in self.fields.items():
@@ -162,6 +305,10 @@ class PhotoMetaApp(QMainWindow):
         self.image_label.people = self.people
         self.image_label.repaint()
 
+        if self.selected_file:
+            self.journal.begin(self.selected_file)
+            self.journaling = True
+
         self.activateWindow()
         self.raise_()
         self.setFocus()
@@ -170,47 +317,166 @@ class PhotoMetaApp(QMainWindow):
         if reason == QSystemTrayIcon.DoubleClick:
             self.open_single_file()
 
+    @property
+    def watched_directory(self) -> Path | None:
+        return self.watcher.roots[0].path if self.watcher.roots else None
+
+    def show_next_scan(self):
+        """Show the next queued scan, unless an image is already being annotated"""
+        if self.isVisible() and self.selected_file:
+            return
+        if self.daemon:
+            if not self.daemon_busy and time.monotonic() >= self.daemon_retry_at:
+                self.call_daemon(self.fetch_lease, self.lease_received)
+            return
+        image = self.watcher.queue.get()
+        if image:
+            self.selected_file = image
+            self.show_window()
+        self.update_tray_tooltip()
+
+    def call_daemon(self, call, on_done=None):
+        """Run a blocking daemon request in the background.
+
+        on_done(result, error) is called in the GUI thread when it is finished.
+        """
+
+        def run():
+            try:
+                result, error = call(), None
+            except (LeaseError, OSError, ValueError) as exception:
+                result, error = None, exception
+            self.daemon_done_signal.emit(on_done, result, error)
+
+        if on_done:
+            self.daemon_busy = True
+        self.daemon_executor.submit(run)
+
+    def daemon_done(self, on_done, result, error):
+        if on_done:
+            self.daemon_busy = False
+        if isinstance(error, OSError):
+            # an unreachable daemon is asked less and less often, up to every 5 minutes
+            self.daemon_failures += 1
+            delay = min(5 * 2**self.daemon_failures, 300)
+            self.daemon_retry_at = time.monotonic() + delay
+            print(f"Could not reach daemon, trying again in {delay} s: {error}")
+        elif error is None:
+            self.daemon_failures = 0
+            self.daemon_retry_at = 0.0
+        if on_done:
+            on_done(result, error)
+
+    def fetch_lease(self) -> tuple[dict, bytes] | None:
+        """Lease the next image and download it, run outside of the GUI thread"""
+        lease = self.daemon.lease()
+        if lease is None:
+            return None
+        try:
+            return lease, self.daemon.image_data(lease["lease"])
+        except OSError:
+            try:
+                self.daemon.release(lease["lease"])
+            except (LeaseError, OSError):
+                pass
+            raise
+
+    def lease_received(self, result, error):
+        if result and self.isVisible() and self.selected_file:
+            # a file was opened by hand while the lease was on its way
+            lease_id = result[0]["lease"]
+            self.call_daemon(lambda: self.daemon.release(lease_id))
+        elif result:
+            self.lease, self.lease_image = result
+            self.selected_file = Path(self.lease["image"])
+            self.show_window()
+        elif isinstance(error, LeaseError):
+            print(f"Could not lease an image: {error}")
+        self.update_tray_tooltip()
+
+    def poll_daemon(self):
+        """Keep the lease of the shown image alive, or ask the daemon for a new image"""
+        if not (self.lease and self.isVisible()):
+            self.show_next_scan()
+            return
+        if self.daemon_busy or time.monotonic() < self.daemon_retry_at:
+            return
+        lease_id = self.lease["lease"]
+        self.call_daemon(lambda: self.daemon.renew(lease_id), self.lease_renewed)
+
+    def lease_renewed(self, result, error):
+        if isinstance(error, LeaseError):
+            print(f"Could not renew lease: {error}")
+
+    def image_moved(self, image, new_image):
+        """Keep annotating an image that was renamed or moved while it was shown"""
+        if not self.selected_file or self.lease:
+            return
+        if self.selected_file.resolve() != Path(image).resolve():
+            return
+        self.selected_file = Path(new_image)
+        self.setWindowTitle(f"Släktskanning - {self.selected_file.name}")
+        if self.journaling:
+            self.journal.moved(self.selected_file)
+
+    def release_lease(self):
+        if self.lease:
+            lease_id = self.lease["lease"]
+            self.call_daemon(lambda: self.daemon.release(lease_id))
+            self.lease = None
+            self.lease_image = b""
+
+    def update_tray_tooltip(self):
+        status = self.daemon.url if self.daemon else self.watcher.status_text()
+        self.tray_icon.setToolTip(f"Släktskanning\n{status}")
+
     def quit_app(self):
-        if self.observer:
-            self.observer.stop()
-            self.observer.join()
+        self.release_lease()
+        self.journal.close()
+        self.watcher.shutdown()
         self.tray_icon.hide()
         QApplication.quit()
 
     def closeEvent(self, event):
         event.ignore()  # Prevent the default close behavior
         self.hide()  # Hide the window, and it will appear in the system tray
-
-    def setup_file_observer(self):
-        if self.observer:
-            self.observer.stop()
-            self.observer.join()
-
-        self.observer = Observer()
-        self.observer.schedule(
-            self.file_handler, path=self.watched_directory, recursive=False
-        )
-        self.observer.start()
-
-    def new_scan(self, event):
-        if event.event_type == "created":
-            image = Path(event.src_path)
-            if image.suffix in [".jpg", ".jpeg", ".png", ".gif"]:
-                self.selected_file = image
-                self.show_window_signal.emit()
+        self.release_lease()
+        if self.selected_file:
+            self.watcher.queue.done(self.selected_file)
+        self.show_window_signal.emit()
+
+    def setup_file_observer(self, roots: list[WatchRoot], save: bool = True):
+        """Watch the folders that can be reached now.
+
+        Offline folders, like a NAS share or an unplugged drive, stay in the config.
+        """
+        self.watch_roots = list(roots)
+        self.watcher.set_roots([root for root in roots if root.path.exists()])
+        if save:
+            save_watch_roots(self.watch_roots)
+            self.index_watched_folders()
+        self.update_tray_tooltip()
+
+    def index_watched_folders(self):
+        """Read the metadata files of watched folders that are not in the indexes yet"""
+        directories = [root.path for root in self.watcher.roots]
+        self.cooccurrence.update_in_background(directories)
+        self.completion.load_in_background(directories)
 
     def open_single_file(self):
+        extensions = " ".join(f"*{extension}" for extension in IMAGE_EXTENSIONS)
         image_file, _ = QFileDialog.getOpenFileName(
             self,
             "Open Image",
             (
                 str(self.watched_directory.absolute())
-                if self.watched_directory.exists()
+                if self.watched_directory and self.watched_directory.exists()
                 else ""
             ),
-            "Image Files (*.png *.jpg *.jpeg *.gif);;All Files (*)",
+            f"Image Files ({extensions});;All Files (*)",
         )
         if image_file:
+            self.release_lease()
             self.selected_file = Path(image_file)
             self.show_window()
         else:
@@ -228,35 +494,89 @@ class PhotoMetaApp(QMainWindow):
             ),
         )
         if folder:
-            self.watched_directory = Path(folder).expanduser()
-            if self.watched_directory.exists():
-                self.setup_file_observer()
-                self.tray_icon.setToolTip(f"Släktskanning\n{self.watched_directory}")
-                save_config({"scan_directory": str(self.watched_directory)})
+            root = WatchRoot(folder)
+            if root.path.exists():
+                self.setup_file_observer([root])
                 self.show()
                 self.hide()
 
+    def add_scan_folder(self):
+        folder = QFileDialog.getExistingDirectory(self, "Lägg till inskanningsmapp")
+        if folder:
+            root = WatchRoot(folder)
+            if root.path.exists() and root.path not in [
+                watched.path for watched in self.watch_roots
+            ]:
+                self.setup_file_observer(self.watch_roots + [root])
+            self.show()
+            self.hide()
+
+    def import_family_tree(self):
+        gedcom_path, _ = QFileDialog.getOpenFileName(
+            self, "Importera släktträd", filter="GEDCOM (*.ged *.GED)"
+        )
+        if gedcom_path:
+            save_config({"gedcom_path": gedcom_path})
+            self.family_tree.import_in_background(
+                gedcom_path, self.family_tree_imported_signal.emit
+            )
+
+    def family_tree_imported(self, counts):
+        if counts is None:
+            self.tray_icon.showMessage(
+                "Släktskanning", "Släktträdet kunde inte importeras"
+            )
+        else:
+            self.tray_icon.showMessage(
+                "Släktskanning",
+                f"{counts['people']} personer i släktträdet, "
+                f"{counts['added']} nya, {counts['changed']} ändrade, "
+                f"{counts['removed']} borttagna",
+            )
+
     def submit(self):
         metadata = []
         for key, value in self.fields.items():
             text_content = get_text_content(value)
             if text_content:
                 metadata.append((key, text_content))
-        save_info(self.selected_file, metadata, self.people)
+        if self.lease:
+            try:
+                meta_file = self.daemon.submit(
+                    self.lease["lease"], metadata, self.people
+                )
+            except (LeaseError, OSError) as error:
+                QMessageBox.warning(
+                    self, "Släktskanning", f"Kunde inte spara metadata: {error}"
+                )
+                return
+            self.lease = None
+            self.lease_image = b""
+        else:
+            try:
+                digest = self.image_digest.result() if self.image_digest else None
+            except OSError:
+                digest = None
+            try:
+                meta_file = save_info(self.selected_file, metadata, self.people, digest)
+            except OSError as error:
+                QMessageBox.warning(
+                    self, "Släktskanning", f"Kunde inte spara metadata: {error}"
+                )
+                return
+            self.image_digest = None
+        self.cooccurrence.add_file(meta_file, metadata, self.people)
+        self.completion.record(metadata)
+        self.journaling = False
+        self.journal.truncate()
         self.hide()
-
-
-class FileHandler(FileSystemEventHandler):
-    def __init__(self, app):
-        self.app = app
-
-    def on_created(self, event):
-        # Wait for file to be written
-        time.sleep(0.5)
-        self.app.new_scan(event)
+        self.watcher.queue.done(self.selected_file)
+        self.show_window_signal.emit()
 
 
 def main():
+    # the post-processing pool starts new processes of the frozen executable on Windows
+    multiprocessing.freeze_support()
     app = QApplication(sys.argv)
     window = PhotoMetaApp()
     sys.exit(app.exec_())